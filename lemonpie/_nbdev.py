@@ -19,11 +19,22 @@ index = {"get_device": "00_basics.ipynb",
          "SYNTHEA_DATAGEN_DATES": "00_basics.ipynb",
          "CONDITIONS": "00_basics.ipynb",
          "LOG_NUMERICALIZE_EXCEP": "00_basics.ipynb",
+         "STORAGE_FORMAT": "00_basics.ipynb",
+         "write_table": "01_preprocessing_clean.ipynb",
+         "read_table": "01_preprocessing_clean.ipynb",
+         "TableWriter": "01_preprocessing_clean.ipynb",
+         "to_categorical": "01_preprocessing_clean.ipynb",
+         "categorical_columns": "01_preprocessing_clean.ipynb",
+         "memory_usage": "01_preprocessing_clean.ipynb",
+         "CATEGORICAL_COLUMNS": "01_preprocessing_clean.ipynb",
          "read_raw_ehrdata": "01_preprocessing_clean.ipynb",
          "split_patients": "01_preprocessing_clean.ipynb",
          "split_ehr_dataset": "01_preprocessing_clean.ipynb",
+         "hash_split_patients": "01_preprocessing_clean.ipynb",
+         "stream_split_ehr_dataset": "01_preprocessing_clean.ipynb",
          "cleanup_pts": "01_preprocessing_clean.ipynb",
          "cleanup_obs": "01_preprocessing_clean.ipynb",
+         "flatten_start_stop": "01_preprocessing_clean.ipynb",
          "cleanup_algs": "01_preprocessing_clean.ipynb",
          "cleanup_crpls": "01_preprocessing_clean.ipynb",
          "cleanup_meds": "01_preprocessing_clean.ipynb",
@@ -33,24 +44,69 @@ index = {"get_device": "00_basics.ipynb",
          "cleanup_immns": "01_preprocessing_clean.ipynb",
          "extract_ys": "01_preprocessing_clean.ipynb",
          "insert_age": "01_preprocessing_clean.ipynb",
+         "SerialExecutor": "01_preprocessing_clean.ipynb",
+         "ProcessExecutor": "01_preprocessing_clean.ipynb",
+         "RayExecutor": "01_preprocessing_clean.ipynb",
+         "get_executor": "01_preprocessing_clean.ipynb",
+         "EXECUTORS": "01_preprocessing_clean.ipynb",
          "clean_preprocess_dataset": "01_preprocessing_clean.ipynb",
+         "group_by_patient": "01_preprocessing_clean.ipynb",
+         "patient_offsets": "01_preprocessing_clean.ipynb",
+         "RecordStore": "01_preprocessing_clean.ipynb",
+         "file_md5": "01_preprocessing_clean.ipynb",
+         "hash_sources": "01_preprocessing_clean.ipynb",
+         "read_manifest": "01_preprocessing_clean.ipynb",
+         "write_manifest": "01_preprocessing_clean.ipynb",
+         "split_patients_md5": "01_preprocessing_clean.ipynb",
+         "cleaned_fmt": "01_preprocessing_clean.ipynb",
          "persist_cleaned": "01_preprocessing_clean.ipynb",
          "clean_raw_ehrdata": "01_preprocessing_clean.ipynb",
          "load_cleaned_ehrdata": "01_preprocessing_clean.ipynb",
          "load_ehr_vocabcodes": "01_preprocessing_clean.ipynb",
+         "load_cleaned_offsets": "01_preprocessing_clean.ipynb",
+         "CleanedEhrData": "01_preprocessing_clean.ipynb",
+         "split_delta_ehr_dataset": "01_preprocessing_clean.ipynb",
+         "clean_delta_ehrdata": "01_preprocessing_clean.ipynb",
+         "hash_bucket_patients": "01_preprocessing_clean.ipynb",
+         "bucket_ehr_dataset": "01_preprocessing_clean.ipynb",
+         "clean_bucket": "01_preprocessing_clean.ipynb",
+         "merge_cleaned_buckets": "01_preprocessing_clean.ipynb",
+         "clean_ehr_buckets": "01_preprocessing_clean.ipynb",
          "test_extract_ys": "01_preprocessing_clean.ipynb",
          "get_label_counts": "01_preprocessing_clean.ipynb",
          "test_cleaned_ehrdata": "01_preprocessing_clean.ipynb",
          "multiple_of_8": "02_preprocessing_vocab.ipynb",
+         "prune_codes": "02_preprocessing_vocab.ipynb",
+         "hash_codes": "02_preprocessing_vocab.ipynb",
+         "UnknownCodes": "02_preprocessing_vocab.ipynb",
+         "unknown_codes": "02_preprocessing_vocab.ipynb",
          "EhrVocab": "02_preprocessing_vocab.ipynb",
          "ObsVocab": "02_preprocessing_vocab.ipynb",
+         "encode_strings": "02_preprocessing_vocab.ipynb",
+         "decode_strings": "02_preprocessing_vocab.ipynb",
+         "read_vocab_stamp": "02_preprocessing_vocab.ipynb",
+         "VOCAB_VERSION": "02_preprocessing_vocab.ipynb",
+         "VOCAB_ARRAYS": "02_preprocessing_vocab.ipynb",
+         "VocabDescs": "02_preprocessing_vocab.ipynb",
          "EhrVocabList": "02_preprocessing_vocab.ipynb",
          "get_all_emb_dims": "02_preprocessing_vocab.ipynb",
+         "get_emb_params": "02_preprocessing_vocab.ipynb",
          "collate_codes_offsts": "03_preprocessing_transform.ipynb",
          "get_codenums_offsts": "03_preprocessing_transform.ipynb",
          "get_demographics": "03_preprocessing_transform.ipynb",
+         "collate_all_codenums_offsts": "03_preprocessing_transform.ipynb",
+         "get_all_demographics": "03_preprocessing_transform.ipynb",
          "Patient": "03_preprocessing_transform.ipynb",
+         "PatientStore": "03_preprocessing_transform.ipynb",
+         "PTSHARD_VERSION": "03_preprocessing_transform.ipynb",
          "get_pckl_dir": "03_preprocessing_transform.ipynb",
+         "ptlist_cache_config": "03_preprocessing_transform.ipynb",
+         "ptlist_cache_config_complete": "03_preprocessing_transform.ipynb",
+         "ptlist_cache_key": "03_preprocessing_transform.ipynb",
+         "ptlist_cache_dir": "03_preprocessing_transform.ipynb",
+         "find_ptlist_cache": "03_preprocessing_transform.ipynb",
+         "evict_ptlist_cache": "03_preprocessing_transform.ipynb",
+         "PTLIST_CACHE_VERSION": "03_preprocessing_transform.ipynb",
          "PatientList": "03_preprocessing_transform.ipynb",
          "cpu_cnt": "03_preprocessing_transform.ipynb",
          "create_all_ptlists": "03_preprocessing_transform.ipynb",
@@ -2,7 +2,7 @@
 
 __all__ = ['get_device', 'settings_template', 'read_settings', 'DEVICE', 'settings', 'DATA_STORE', 'LOG_STORE',
            'MODEL_STORE', 'EXPERIMENT_STORE', 'PATH_1K', 'PATH_10K', 'PATH_20K', 'PATH_100K', 'FILENAMES',
-           'SYNTHEA_DATAGEN_DATES', 'CONDITIONS', 'LOG_NUMERICALIZE_EXCEP']
+           'SYNTHEA_DATAGEN_DATES', 'CONDITIONS', 'LOG_NUMERICALIZE_EXCEP', 'STORAGE_FORMAT']
 
 # Cell
 from fastai.imports import *
@@ -54,7 +54,8 @@ def settings_template():
             'rheumatoid_arthritis': '69896004',
             'epilepsy': '84757009'
         },
-        'LOG_NUMERICALIZE_EXCEP': True
+        'LOG_NUMERICALIZE_EXCEP': True,
+        'STORAGE_FORMAT': 'csv'
     }
 
     return template
@@ -97,4 +98,6 @@ SYNTHEA_DATAGEN_DATES = settings.SYNTHEA_DATAGEN_DATES
 
 CONDITIONS = settings.CONDITIONS
 
-LOG_NUMERICALIZE_EXCEP = settings.LOG_NUMERICALIZE_EXCEP
\ No newline at end of file
+LOG_NUMERICALIZE_EXCEP = settings.LOG_NUMERICALIZE_EXCEP
+
+STORAGE_FORMAT = settings.get('STORAGE_FORMAT', 'csv')
\ No newline at end of file
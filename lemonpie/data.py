@@ -6,6 +6,7 @@ __all__ = ['EHRDataSplits', 'LabelEHRData', 'EHRDataset', 'ModalityTypeBatchSamp
 # Cell
 from .basics import *
 from .preprocessing.transform import *
+from .preprocessing.vocab import *
 from fastai.imports import *
 import copy, glob
 
@@ -13,19 +14,48 @@ import copy, glob
 class EHRDataSplits:
     """Class to hold the PatientList splits."""
 
-    def __init__(self, path, age_start, age_range, start_is_date, age_in_months):
+    def __init__(
+        self,
+        path,
+        age_start,
+        age_range,
+        start_is_date,
+        age_in_months,
+        vocab_path=None,
+        modalities_file_path=None,
+    ):
 
         self.splits, self.modality_types = self._load_splits(
-            path, age_start, age_range, start_is_date, age_in_months
+            path,
+            age_start,
+            age_range,
+            start_is_date,
+            age_in_months,
+            vocab_path,
+            modalities_file_path,
         )
 
-    def _load_splits(self, path, age_start, age_range, start_is_date, age_in_months):
+    def _load_splits(
+        self,
+        path,
+        age_start,
+        age_range,
+        start_is_date,
+        age_in_months,
+        vocab_path=None,
+        modalities_file_path=None,
+    ):
         """Load splits of preprocessed `PatientList`s from persistent store using path."""
         splits = {}
         modality_types = {}
+        vocab_stamp = read_vocab_stamp(path if vocab_path is None else vocab_path)
+        # cached patient lists created with the current vocabs, cleaned data & modalities, if there are any
+        cache_key = find_ptlist_cache(
+            path, age_start, age_range, start_is_date, age_in_months, vocab_path, modalities_file_path
+        )
         for split in ["train", "valid", "test"]:
             pckl_dir = get_pckl_dir(
-                path, split, 999, age_start, age_range, age_in_months
+                path, split, 999, age_start, age_range, age_in_months, cache_key
             )
             mod_types = [
                 mod_type.name.split("_")[-1] for mod_type in pckl_dir.parent.iterdir()
@@ -41,6 +71,8 @@ class EHRDataSplits:
                     age_range=age_range,
                     start_is_date=start_is_date,
                     age_in_months=age_in_months,
+                    vocab_stamp=vocab_stamp,
+                    cache_key=cache_key,
                 )
                 for m_type in mod_types
             ]
@@ -134,6 +166,8 @@ class EHRDataset(torch.utils.data.Dataset):
         If `lazy_load_gpu` is `False`, load entire dataset on GPU."""
 
         self.x, self.y = ptlist, self._get_y(ptlist, labels)
+        # patients of a `PatientStore` are created on access, so need not be copied
+        self.from_store = isinstance(getattr(ptlist, "items", ptlist), PatientStore)
         # self.m = torch.full((len(ptlist), 1), modality_type)
         self.m = modality_type
         self.lazy = lazy_load_gpu
@@ -145,6 +179,9 @@ class EHRDataset(torch.utils.data.Dataset):
 
     def _get_y(self, ptlist, labels):
         """Extract y from each patient object in ptlist and stack them."""
+        items = getattr(ptlist, "items", ptlist)
+        if isinstance(items, PatientStore):
+            return torch.from_numpy(items.labels(labels)).float()
         y = []
         for pt in ptlist:
             y.append(
@@ -163,7 +200,9 @@ class EHRDataset(torch.utils.data.Dataset):
     def __getitem__(self, i):
         """If lazy loading, return deep copy of patient object `i`
         else entire dataset already on GPU - just return `i`."""
-        if self.lazy:
+        if self.lazy and self.from_store:
+            return self.x[i], self.y[i], self.m
+        elif self.lazy:
             return copy.deepcopy(self.x[i]), self.y[i], self.m  # make m[i] if tensor
         else:
             return self.x[i], self.y[i], self.m
@@ -381,11 +420,14 @@ class MultimodalEHRData:
         start_is_date,
         age_in_months,
         lazy_load_gpu=True,
+        vocab_path=None,
+        modalities_file_path=None,
     ):
         self.path, self.labels = path, labels
         self.age_start, self.age_range = age_start, age_range
         self.start_is_date, self.age_in_months = start_is_date, age_in_months
         self.lazy_load_gpu = lazy_load_gpu
+        self.vocab_path, self.modalities_file_path = vocab_path, modalities_file_path
 
     def load_splits(self):
         """Load data splits given dataset path."""
@@ -395,6 +437,8 @@ class MultimodalEHRData:
             self.age_range,
             self.start_is_date,
             self.age_in_months,
+            self.vocab_path,
+            self.modalities_file_path,
         )
         self.splits, self.modality_types = self.data_splits.get_splits_modtypes()
 
@@ -1,19 +1,118 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/01_preprocessing_clean.ipynb (unless otherwise specified).
 
-__all__ = ['read_raw_ehrdata', 'split_patients', 'split_ehr_dataset', 'cleanup_pts', 'cleanup_obs', 'cleanup_algs',
+__all__ = ['write_table', 'read_table', 'TableWriter', 'to_categorical', 'categorical_columns', 'memory_usage',
+           'CATEGORICAL_COLUMNS', 'read_raw_ehrdata', 'split_patients', 'split_ehr_dataset', 'hash_split_patients',
+           'stream_split_ehr_dataset', 'cleanup_pts', 'cleanup_obs', 'flatten_start_stop', 'cleanup_algs',
            'cleanup_crpls', 'cleanup_meds', 'cleanup_img', 'cleanup_procs', 'cleanup_cnds', 'cleanup_immns',
-           'extract_ys', 'insert_age', 'clean_preprocess_dataset', 'persist_cleaned', 'clean_raw_ehrdata',
-           'load_cleaned_ehrdata', 'load_ehr_vocabcodes', 'test_extract_ys', 'get_label_counts', 'test_cleaned_ehrdata']
+           'extract_ys', 'insert_age', 'SerialExecutor', 'ProcessExecutor', 'RayExecutor', 'get_executor', 'EXECUTORS',
+           'clean_preprocess_dataset', 'group_by_patient', 'patient_offsets', 'RecordStore', 'file_md5', 'hash_sources',
+           'read_manifest', 'write_manifest', 'split_patients_md5', 'cleaned_fmt', 'persist_cleaned',
+           'clean_raw_ehrdata', 'load_cleaned_ehrdata', 'load_ehr_vocabcodes', 'load_cleaned_offsets', 'CleanedEhrData',
+           'split_delta_ehr_dataset', 'clean_delta_ehrdata', 'hash_bucket_patients', 'bucket_ehr_dataset',
+           'clean_bucket', 'merge_cleaned_buckets', 'clean_ehr_buckets', 'test_extract_ys', 'get_label_counts',
+           'test_cleaned_ehrdata']
 
 # Cell
 from ..basics import *
 from fastai.imports import *
-import ray
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import time
 
 # Cell
-def read_raw_ehrdata(path, csv_names = FILENAMES):
+def write_table(df, path, name, fmt=STORAGE_FORMAT, index=True, index_label=None, append=False):
+    '''Write a single EHR table to `path` as `csv` or `parquet` - or `append` it to the existing table'''
+    if fmt == 'csv':
+        df.to_csv(f'{path}/{name}.csv', index=index, index_label=index_label, mode='a' if append else 'w', header=not append)
+    elif fmt == 'parquet':
+        if index and index_label is not None: df = df.rename_axis(index_label)
+        fname = Path(f'{path}/{name}.parquet')
+        if append:
+            # an appended table is a directory of part files, so each append only writes its own rows
+            if fname.is_file():
+                first = fname.rename(f'{fname}.part')
+                fname.mkdir()
+                first.rename(fname/'part-00000.parquet')
+            fname.mkdir(exist_ok=True)
+            df.to_parquet(fname/f'part-{len(list(fname.glob("part-*.parquet"))):05d}.parquet', index=index)
+        else:
+            if fname.is_dir(): shutil.rmtree(fname)
+            df.to_parquet(fname, index=index)
+    else:
+        raise ValueError(f'Unknown storage format "{fmt}", must be one of "csv" or "parquet"')
+
+# Cell
+def read_table(path, name, fmt=STORAGE_FORMAT, columns=None, index_col=None, **csv_kwargs):
+    '''Read a single EHR table from `path`, optionally only the given `columns` (the index is always read)'''
+    if fmt == 'csv':
+        fname = f'{path}/{name}.csv'
+        usecols = None
+        if columns is not None:
+            usecols = list(columns)
+            if index_col is not None:
+                index_col = pd.read_csv(fname, nrows=0).columns[index_col]
+                usecols.append(index_col)
+        return pd.read_csv(fname, low_memory=False, usecols=usecols, index_col=index_col, **csv_kwargs)
+    elif fmt == 'parquet':
+        fname, columns = Path(f'{path}/{name}.parquet'), None if columns is None else list(columns)
+        if fname.is_dir():
+            parts = [pd.read_parquet(part, columns=columns) for part in sorted(fname.glob('part-*.parquet'))]
+            return to_categorical(pd.concat(parts), categorical_columns(parts[0]))
+        return pd.read_parquet(fname, columns=columns)
+    else:
+        raise ValueError(f'Unknown storage format "{fmt}", must be one of "csv" or "parquet"')
+
+# Cell
+class TableWriter:
+    '''Append chunks of a single EHR table to a `csv` or `parquet` file in `path` - with their index if `index`'''
+    def __init__(self, path, name, fmt=STORAGE_FORMAT, index=False):
+        if fmt not in ['csv', 'parquet']: raise ValueError(f'Unknown storage format "{fmt}", must be one of "csv" or "parquet"')
+        self.fname, self.fmt, self.index = f'{path}/{name}.{fmt}', fmt, index
+        self.writer, self.schema, self.rows = None, None, 0
+
+    def append(self, df):
+        '''Append a chunk - the first chunk determines the columns'''
+        if self.fmt == 'csv':
+            df.to_csv(self.fname, mode='a' if self.schema else 'w', header=self.schema is None, index=self.index)
+            self.schema = list(df.columns)
+        else:
+            import pyarrow as pa, pyarrow.parquet as pq
+            if self.schema is None:
+                # all-null object columns in the first chunk would otherwise be typed as null
+                # & category codes are widened as later chunks can have more categories
+                schema = pa.Schema.from_pandas(df, preserve_index=self.index)
+                self.schema = pa.schema([pa.field(f.name, pa.string()) if f.type == pa.null() else
+                                         pa.field(f.name, pa.dictionary(pa.int32(), f.type.value_type)) if pa.types.is_dictionary(f.type) else f
+                                         for f in schema], metadata=schema.metadata)
+                self.writer = pq.ParquetWriter(self.fname, self.schema)
+            self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=self.index))
+        self.rows += len(df)
+
+    def close(self):
+        '''Close the file, must be called once all chunks are appended'''
+        if self.writer is not None: self.writer.close()
+        return self.rows
+
+# Cell
+CATEGORICAL_COLUMNS = ['patient', 'code', 'orig_code', 'units', 'type', 'marital', 'race', 'ethnicity', 'gender', 'birthplace', 'city', 'state']
+
+def to_categorical(df, columns=CATEGORICAL_COLUMNS):
+    '''Convert the given columns (& index) of a table to `category` dtype'''
+    df = df.astype({col: 'category' for col in df.columns if col in columns and df[col].dtype != 'category'})
+    if df.index.name in columns and df.index.dtype != 'category': df.index = pd.CategoricalIndex(df.index, name=df.index.name)
+    return df
+
+def categorical_columns(df):
+    '''Names of the `category` columns (& index) of a table'''
+    return [name for name, dtype in [(df.index.name, df.index.dtype), *df.dtypes.items()] if dtype == 'category']
+
+def memory_usage(dfs, names):
+    '''Memory used (in MB, including the index & strings) by each table'''
+    return pd.Series([df.memory_usage(index=True, deep=True).sum() / 2**20 for df in dfs], index=names, name='MB')
+
+# Cell
+def read_raw_ehrdata(path, csv_names = FILENAMES, fmt='csv'):
     '''Read raw EHR data'''
-    dfs = [pd.read_csv(f'{path}/{fname}.csv', low_memory=False) for fname in csv_names]
+    dfs = [read_table(path, fname, fmt) for fname in csv_names]
     return dfs
 
 # Cell
@@ -25,7 +124,7 @@ def split_patients(patients, valid_pct=0.2, test_pct=0.2, random_state=1234):
     return np.split(patients, [int(train_pct*len(patients)), int((train_pct+valid_pct)*len(patients))])
 
 # Cell
-def split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234):
+def split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234, fmt=STORAGE_FORMAT):
     '''Split EHR dataset into train, valid, test and save'''
 
     train_dfs, valid_dfs, test_dfs = [],[],[]
@@ -56,21 +155,50 @@ def split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234):
 
         if split == 'train':
             for df, name in zip(train_dfs, FILENAMES):
-                df.to_csv(f'{d}/{name}.csv', index=False)
+                write_table(df, d, name, fmt, index=False)
             print(f'Saved train data to {d}')
 
         if split == 'valid':
             for df, name in zip(valid_dfs, FILENAMES):
-                df.to_csv(f'{d}/{name}.csv', index=False)
+                write_table(df, d, name, fmt, index=False)
             print(f'Saved valid data to {d}')
 
         if split == 'test':
             for df, name in zip(test_dfs, FILENAMES):
-                df.to_csv(f'{d}/{name}.csv', index=False)
+                write_table(df, d, name, fmt, index=False)
             print(f'Saved test data to {d}')
 
 # Cell
-@ray.remote(num_returns=3)
+def hash_split_patients(ptids, valid_pct=0.2, test_pct=0.2, random_state=1234):
+    '''Assign patient ids to splits (0 - train, 1 - valid, 2 - test) deterministically, by hashing the ids'''
+    train_pct = 1 - (valid_pct + test_pct)
+    hash_key = f'{random_state:016d}'[-16:]
+    hashes = pd.util.hash_pandas_object(pd.Series(ptids), index=False, hash_key=hash_key).values
+    uniform = (hashes >> np.uint64(11)) / float(2**53) # top 53 bits -> [0,1)
+    return np.digitize(uniform, [train_pct, train_pct + valid_pct])
+
+# Cell
+def stream_split_ehr_dataset(path, valid_pct=0.2, test_pct=0.2, random_state=1234, chunksize=1_000_000, fmt=STORAGE_FORMAT):
+    '''Split EHR dataset into train, valid, test and save - reading & writing each table in chunks'''
+    split_dirs = [Path(f'{path}/raw_split/{split}') for split in ['train', 'valid', 'test']]
+    for d in split_dirs: d.mkdir(parents=True, exist_ok=True)
+
+    for name in FILENAMES:
+        writers = [TableWriter(d, name, fmt) for d in split_dirs]
+        total = 0
+        for chunk in pd.read_csv(f'{path}/raw_original/{name}.csv', dtype=str, chunksize=chunksize):
+            if name == FILENAMES[0]: chunk.rename(str.lower, axis='columns', inplace=True)
+            split_ids = hash_split_patients(chunk['id' if name == FILENAMES[0] else 'PATIENT'], valid_pct, test_pct, random_state)
+            for i, writer in enumerate(writers):
+                writer.append(chunk[split_ids == i])
+            total += len(chunk)
+        n_train, n_valid, n_test = [writer.close() for writer in writers]
+        assert total == n_train+n_valid+n_test, f'Split failed {name}: {total} != {n_train}+{n_valid}+{n_test}'
+        print(f'Split {name} into:: Train: {n_train}, Valid: {n_valid}, Test: {n_test} -- Total before split: {total}')
+
+    print(f'Saved train, valid & test data to {Path(f"{path}/raw_split")}')
+
+# Cell
 def cleanup_pts(pts, is_train, today=None):
     '''Clean patients df'''
 
@@ -78,7 +206,7 @@ def cleanup_pts(pts, is_train, today=None):
     pts = pts.loc[:, ['id', 'birthdate', 'marital', 'race', 'ethnicity', 'gender', 'birthplace', 'city', 'state', 'zip']]
     pts.rename(columns={"id":"patient"}, inplace=True)
     pts = pts.astype({'birthdate':'datetime64'})
-    pts['zip'] = pts['zip'].fillna(0.0).astype(int)
+    pts['zip'] = pd.to_numeric(pts['zip']).fillna(0.0).astype(int)
     if today == None: today = pd.Timestamp.today()
     else            : today = pd.to_datetime(today)
     pts['age_now_days'] = pts['birthdate'].apply(lambda bday: (today-bday).days)
@@ -92,7 +220,6 @@ def cleanup_pts(pts, is_train, today=None):
     return [patients, pt_demographics, pt_codes] if is_train else [patients, pt_demographics, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_obs(obs, is_train):
     '''Clean observations df'''
 
@@ -112,21 +239,26 @@ def cleanup_obs(obs, is_train):
     return [obs, obs_codes] if is_train else [obs, None]
 
 # Cell
-@ray.remote(num_returns=2)
+def flatten_start_stop(df):
+    '''Flatten `start` & `stop` dates in each row into separate `||START` & `||STOP` coded events with a single `date`'''
+    has_stop = df['stop'].notnull().values
+    code_nums, uniq_codes = pd.factorize(df['code'].fillna('nan'))
+    uniq_codes = uniq_codes.astype(str)
+
+    starts = df.drop(columns=['stop']).rename(columns={'start':'date', 'description':'desc'})
+    stops  = df.loc[has_stop].drop(columns=['start']).rename(columns={'stop':'date', 'description':'desc'})
+    starts['code'] = (uniq_codes + '||START').values.take(code_nums)
+    stops['code']  = (uniq_codes + '||STOP').values.take(code_nums[has_stop])
+
+    return pd.concat([starts, stops], ignore_index=True)
+
+# Cell
 def cleanup_algs(allergies, is_train):
     '''Clean allergies df'''
 
     allergies.rename(str.lower, axis='columns', inplace=True)
     allergies.drop(columns=['encounter'], inplace=True)
-
-    stops = pd.DataFrame(allergies.loc[allergies['stop'].notnull(),:])
-    allergies['code'] = allergies['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    allergies.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    allergies.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date", "description":"desc"}, inplace=True)
-    allergies = allergies.append(stops, ignore_index=True)
+    allergies = flatten_start_stop(allergies)
 
     if is_train: alg_codes = allergies.loc[:, ['code', 'desc']]
 
@@ -136,21 +268,12 @@ def cleanup_algs(allergies, is_train):
     return [allergies, alg_codes] if is_train else [allergies, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_crpls(careplans, is_train):
     '''Clean careplans df'''
 
     careplans.rename(str.lower, axis='columns', inplace=True)
     careplans = careplans.loc[:, ['start', 'stop', 'patient', 'code', 'description']]
-
-    stops = pd.DataFrame(careplans.loc[careplans['stop'].notnull(),:])
-    careplans['code'] = careplans['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    careplans.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    careplans.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date", "description":"desc"}, inplace=True)
-    careplans = careplans.append(stops, ignore_index=True)
+    careplans = flatten_start_stop(careplans)
 
     if is_train: crpl_codes = careplans.loc[:, ['code', 'desc']]
 
@@ -160,21 +283,12 @@ def cleanup_crpls(careplans, is_train):
     return [careplans, crpl_codes] if is_train else [careplans, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_meds(medications, is_train):
     '''Clean `medications` df'''
 
     medications.rename(str.lower, axis='columns', inplace=True)
     medications = medications.loc[:, ['start', 'stop', 'patient', 'code', 'description']]
-
-    stops = pd.DataFrame(medications.loc[medications['stop'].notnull(),:])
-    medications['code'] = medications['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    medications.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    medications.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date", "description":"desc"}, inplace=True)
-    medications = medications.append(stops, ignore_index=True)
+    medications = flatten_start_stop(medications)
 
     if is_train: med_codes = medications.loc[:, ['code', 'desc']]
 
@@ -184,7 +298,6 @@ def cleanup_meds(medications, is_train):
     return [medications, med_codes] if is_train else [medications, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_img(imaging_studies, is_train):
     '''Clean `imaging` df'''
 
@@ -198,7 +311,6 @@ def cleanup_img(imaging_studies, is_train):
     return [imaging_studies, img_codes] if is_train else [imaging_studies, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_procs(procedures, is_train):
     '''Clean `procedures` df'''
 
@@ -212,20 +324,12 @@ def cleanup_procs(procedures, is_train):
     return [procedures, proc_codes] if is_train else [procedures, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_cnds(conditions, is_train):
     '''Clean `conditions` df'''
 
     conditions.rename(str.lower, axis='columns', inplace=True)
     conditions.drop(columns=['encounter'], inplace=True)
-    stops = pd.DataFrame(conditions.loc[conditions['stop'].notnull(),:])
-    conditions['code'] = conditions['code'].apply(lambda x: f'{str(x)}||START')
-    stops['code'] = stops['code'].apply(lambda x: f'{str(x)}||STOP')
-    conditions.drop(columns=['stop'], inplace=True)
-    stops.drop(columns=['start'], inplace=True)
-    conditions.rename(columns={"start":"date", "description":"desc"}, inplace=True)
-    stops.rename(columns={"stop":"date","description":"desc"}, inplace=True)
-    conditions = conditions.append(stops, ignore_index=True)
+    conditions = flatten_start_stop(conditions)
 
     if is_train: cnd_codes = conditions.loc[:, ['code', 'desc']]
 
@@ -235,7 +339,6 @@ def cleanup_cnds(conditions, is_train):
     return [conditions, cnd_codes] if is_train else [conditions, None]
 
 # Cell
-@ray.remote(num_returns=2)
 def cleanup_immns(immunizations, is_train):
     '''Clean `immunizations` df'''
 
@@ -249,18 +352,21 @@ def cleanup_immns(immunizations, is_train):
     return [immunizations, imm_codes] if is_train else [immunizations, None]
 
 # Cell
-@ray.remote
 def extract_ys(patients, conditions, cnd_dict):
-    '''Extract labels from conditions df and add them to patients df with age.'''
-    for key in cnd_dict.keys():
-        patients = patients.merge(conditions[conditions.code==f'{cnd_dict[key]}||START'], how='left', left_index=True, right_index=True)
-        patients[f'{key}'] = patients.code.notna()
-        patients[f'{key}_age'] = ((patients.date - patients.birthdate)//np.timedelta64(1,'Y'))
-        patients = patients.drop(columns=['date','code'])
-    return patients
+    '''Extract labels & age at first onset for all conditions in `cnd_dict` in a single pass over conditions df and add them to patients df'''
+    labels = pd.DataFrame({'label': list(cnd_dict.keys()), 'code': [f'{code}||START' for code in cnd_dict.values()]})
+    starts = conditions[conditions.code.isin(labels.code)]
+    starts = pd.DataFrame({'patient': starts.index, 'code': starts.code.values, 'date': starts.date.values}).merge(labels, on='code')
+    onsets = starts.groupby(['patient', 'label']).date.min().unstack()
+    onsets = onsets.reindex(index=patients.index, columns=labels.label).astype('datetime64[ns]')
+
+    ys = {}
+    for label in labels.label:
+        ys[label] = onsets[label].notna().values
+        ys[f'{label}_age'] = ((onsets[label] - patients.birthdate)//np.timedelta64(1,'Y')).values
+    return pd.concat([patients, pd.DataFrame(ys, index=patients.index)], axis=1)
 
 # Cell
-@ray.remote
 def insert_age(df, pts_df):
     '''Insert age in years and months into each of the rec dfs'''
 
@@ -270,29 +376,157 @@ def insert_age(df, pts_df):
     return df.drop(columns=['birthdate'])
 
 # Cell
-@ray.remote(num_returns=2)
-def clean_preprocess_dataset(path, is_train, conditions_dict, today=None):
-    '''Cleans and preprocesses all dfs in a single split'''
-    dfs = read_raw_ehrdata(path)
+def _flatten_args(args):
+    '''Flatten list args (one level) so executors can resolve all task handles passed to a task'''
+    flat, lens = [], []
+    for arg in args:
+        if isinstance(arg, list): flat.extend(arg); lens.append(len(arg))
+        else                    : flat.append(arg); lens.append(None)
+    return flat, lens
+
+def _unflatten_args(flat, lens):
+    '''Reverse of `_flatten_args`'''
+    args, i = [], 0
+    for n in lens:
+        if n is None: args.append(flat[i]); i += 1
+        else        : args.append(list(flat[i:i+n])); i += n
+    return args
+
+def _run_task(fn, num_returns, lens, kwargs, *flat_args):
+    '''Run and time a single task - returns its `num_returns` results followed by `(task name, seconds)`'''
+    start = time.perf_counter()
+    res = fn(*_unflatten_args(flat_args, lens), **kwargs)
+    timing = (fn.__name__, time.perf_counter() - start)
+    return [*res, timing] if num_returns > 1 else [res, timing]
+
+# Cell
+class SerialExecutor():
+    '''Run tasks one after the other in this process - also the base class for the other executors'''
+    def __init__(self, max_workers=None):
+        self.timings = []
+
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        '''Run `fn` on `args` (which can be handles to results of other tasks) - returns `num_returns` handles'''
+        flat, lens = _flatten_args(args)
+        *res, timing = _run_task(fn, num_returns, lens, kwargs, *flat)
+        return self._add_timing(res, timing, num_returns)
+
+    def _add_timing(self, res, timing, num_returns):
+        self.timings.append(timing)
+        return res if num_returns > 1 else res[0]
+
+    def get(self, handles):
+        '''Get the result(s) of a handle or list of handles'''
+        return handles
 
-    pt_data   = cleanup_pts.remote(dfs[0],   is_train, today)
-    obs_data  = cleanup_obs.remote(dfs[1],   is_train)
-    alg_data  = cleanup_algs.remote(dfs[2],  is_train)
-    crpl_data = cleanup_crpls.remote(dfs[3], is_train)
-    med_data  = cleanup_meds.remote(dfs[4],  is_train)
-    img_data  = cleanup_img.remote(dfs[5],   is_train)
-    proc_data = cleanup_procs.remote(dfs[6], is_train)
-    cnd_data  = cleanup_cnds.remote(dfs[7],  is_train)
-    imm_data  = cleanup_immns.remote(dfs[8], is_train)
+    def as_completed(self, handles):
+        '''Yield results as the tasks complete'''
+        for handle in handles: yield self.get(handle)
+
+    def task_times(self):
+        '''Number of runs, total, mean & max seconds spent in each task'''
+        times = pd.DataFrame(self.get(self.timings), columns=['task', 'seconds'])
+        return times.groupby('task').seconds.agg(['count', 'sum', 'mean', 'max']).sort_values('sum', ascending=False)
+
+    def shutdown(self): pass
+
+# Cell
+def _item_future(fut, i):
+    '''Future for the `i`th result of a multi-result task'''
+    item = Future()
+    def _set(f):
+        if f.exception() is not None: item.set_exception(f.exception())
+        else                        : item.set_result(f.result()[i])
+    fut.add_done_callback(_set)
+    return item
+
+class ProcessExecutor(SerialExecutor):
+    '''Run tasks on a local process pool, each task is launched as soon as its inputs are ready'''
+    def __init__(self, max_workers=None):
+        super().__init__()
+        self.pool = ProcessPoolExecutor(max_workers)
+        # driver side threads wait on a task's inputs, then hand it to the pool
+        # tasks are always submitted after their inputs, so these can't deadlock
+        self.launcher = ThreadPoolExecutor(64)
+
+    def _launch(self, fn, num_returns, lens, kwargs, flat):
+        flat = [arg.result() if isinstance(arg, Future) else arg for arg in flat]
+        return self.pool.submit(_run_task, fn, num_returns, lens, kwargs, *flat).result()
+
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        flat, lens = _flatten_args(args)
+        fut = self.launcher.submit(self._launch, fn, num_returns, lens, kwargs, flat)
+        res = [_item_future(fut, i) for i in range(num_returns)]
+        return self._add_timing(res, _item_future(fut, num_returns), num_returns)
+
+    def get(self, handles):
+        return [h.result() for h in handles] if isinstance(handles, list) else handles.result()
+
+    def as_completed(self, handles):
+        for handle in as_completed(handles): yield handle.result()
+
+    def shutdown(self):
+        self.launcher.shutdown()
+        self.pool.shutdown()
+
+# Cell
+class RayExecutor(SerialExecutor):
+    '''Run tasks on Ray - handles are Ray object refs which Ray resolves before running a task'''
+    def __init__(self, max_workers=None):
+        super().__init__()
+        import ray
+        self.ray, self.remotes = ray, {}
+        if not ray.is_initialized(): ray.init(num_cpus=max_workers)
+
+    def submit(self, fn, *args, num_returns=1, **kwargs):
+        flat, lens = _flatten_args(args)
+        if num_returns not in self.remotes: self.remotes[num_returns] = self.ray.remote(num_returns=num_returns+1)(_run_task)
+        *res, timing = self.remotes[num_returns].remote(fn, num_returns, lens, kwargs, *flat)
+        return self._add_timing(res, timing, num_returns)
+
+    def get(self, handles):
+        return self.ray.get(handles)
+
+    def as_completed(self, handles):
+        remaining = list(handles)
+        while len(remaining) > 0:
+            ready, remaining = self.ray.wait(remaining)
+            for r in ready: yield self.ray.get(r)
+
+# Cell
+EXECUTORS = {'ray': RayExecutor, 'process': ProcessExecutor, 'serial': SerialExecutor}
+
+def get_executor(executor='ray', max_workers=None):
+    '''Get an executor by name (`ray`, `process` or `serial`) - executor objects are passed through'''
+    if not isinstance(executor, str): return executor
+    if executor not in EXECUTORS: raise ValueError(f'Unknown executor "{executor}" - should be one of {list(EXECUTORS)}')
+    return EXECUTORS[executor](max_workers)
+
+# Cell
+def clean_preprocess_dataset(path, is_train, conditions_dict, today=None, fmt=STORAGE_FORMAT, executor=None, categorical=False):
+    '''Cleans and preprocesses all dfs in a single split - returns `executor` handles to the data (& code) tables'''
+    executor = SerialExecutor() if executor is None else executor
+    dfs = executor.submit(read_raw_ehrdata, path, FILENAMES, fmt, num_returns=len(FILENAMES))
+
+    pt_data   = executor.submit(cleanup_pts,   dfs[0], is_train, today, num_returns=3)
+    obs_data  = executor.submit(cleanup_obs,   dfs[1], is_train, num_returns=2)
+    alg_data  = executor.submit(cleanup_algs,  dfs[2], is_train, num_returns=2)
+    crpl_data = executor.submit(cleanup_crpls, dfs[3], is_train, num_returns=2)
+    med_data  = executor.submit(cleanup_meds,  dfs[4], is_train, num_returns=2)
+    img_data  = executor.submit(cleanup_img,   dfs[5], is_train, num_returns=2)
+    proc_data = executor.submit(cleanup_procs, dfs[6], is_train, num_returns=2)
+    cnd_data  = executor.submit(cleanup_cnds,  dfs[7], is_train, num_returns=2)
+    imm_data  = executor.submit(cleanup_immns, dfs[8], is_train, num_returns=2)
 
     data_tables = [pt_data[0], pt_data[1], obs_data[0], alg_data[0], crpl_data[0], med_data[0], img_data[0], proc_data[0], cnd_data[0], imm_data[0]]
 
     patients, patient_demographics, conditions, rec_tables = data_tables[0], data_tables[1], data_tables[8], data_tables[2:]
-    rec_dfs = [insert_age.remote(rec_df, patients) for rec_df in rec_tables]
-    patients = extract_ys.remote(patients, conditions, conditions_dict)
+    rec_dfs = [executor.submit(insert_age, rec_df, patients) for rec_df in rec_tables]
+    patients = executor.submit(extract_ys, patients, conditions, conditions_dict)
 
     data_tables = [patients, patient_demographics]
     data_tables.extend(rec_dfs)
+    if categorical: data_tables = [executor.submit(to_categorical, df) for df in data_tables]
 
     if is_train:
         code_tables = [pt_data[2], obs_data[1], alg_data[1], crpl_data[1], med_data[1], img_data[1], proc_data[1], cnd_data[1], imm_data[1]]
@@ -300,23 +534,96 @@ def clean_preprocess_dataset(path, is_train, conditions_dict, today=None):
     return (data_tables, code_tables) if is_train else (data_tables, None)
 
 # Cell
-@ray.remote
-def persist_cleaned(path, split_name, cleaned_dfs, code_tables=None):
-    '''Save cleaned EHR data to disk'''
+def group_by_patient(df):
+    '''Reorder a record table (stable) so each patient's rows are contiguous - patients in order of first appearance'''
+    ptnums, _ = pd.factorize(df.index)
+    order = np.argsort(ptnums, kind='stable')
+    return df if (order == np.arange(len(df))).all() else df.iloc[order]
+
+def patient_offsets(df, start_row=0):
+    '''Start & stop rows of each patient in a record table grouped by patient, offset by `start_row`'''
+    ptids = df.index.values
+    if len(ptids) == 0: starts = stops = np.zeros(0, dtype=int)
+    else:
+        starts = np.flatnonzero(np.r_[True, ptids[1:] != ptids[:-1]])
+        stops  = np.append(starts[1:], len(ptids))
+    return pd.DataFrame({'start': starts + start_row, 'stop': stops + start_row}, index=pd.Index(ptids[starts], name='patient'))
+
+# Cell
+class RecordStore:
+    '''Per-patient slices of a record table grouped by patient - offsets are computed if not given'''
+    def __init__(self, df, offsets=None):
+        if offsets is None:
+            df = group_by_patient(df)
+            offsets = patient_offsets(df)
+        self.df = df
+        self.offsets = dict(zip(offsets.index, zip(offsets['start'].values, offsets['stop'].values)))
+
+    def __len__(self): return len(self.offsets)
+    def __contains__(self, ptid): return ptid in self.offsets
+
+    def __getitem__(self, ptid):
+        '''Records of a single patient (empty if there are none) - a view, not a copy'''
+        start, stop = self.offsets.get(ptid, (0, 0))
+        return self.df.iloc[start:stop]
+
+# Cell
+def file_md5(fname, chunk_bytes=2**20):
+    '''md5 hex digest of a file, read in chunks'''
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_bytes), b''): md5.update(chunk)
+    return md5.hexdigest()
+
+def hash_sources(src_dir, csv_names=FILENAMES):
+    '''md5 of each raw csv in `src_dir`, keyed by its full path'''
+    return {str(Path(f'{src_dir}/{name}.csv').resolve()): file_md5(f'{src_dir}/{name}.csv') for name in csv_names}
+
+# Cell
+def read_manifest(path):
+    '''Read the manifest of the cleaned data (processed patients & source files) - `None` if there is none'''
+    fname = Path(f'{path}/cleaned/manifest.json')
+    return json.loads(fname.read_text()) if fname.exists() else None
+
+def write_manifest(path, manifest):
+    '''Save the manifest of the cleaned data - with sorted keys, so the same cleaned data always gives the same file'''
+    Path(f'{path}/cleaned/manifest.json').write_text(json.dumps(manifest, sort_keys=True))
+
+def split_patients_md5(path, split_name, fmt=STORAGE_FORMAT):
+    '''md5 of the sorted patient ids of a cleaned split - tells apart splits of the same size with different patients'''
+    ptids = read_table(f'{path}/cleaned/{split_name}', 'patients', fmt, columns=['patient'], index_col=0)['patient']
+    return hashlib.md5('\n'.join(sorted(ptids.astype(str))).encode()).hexdigest()
+
+def cleaned_fmt(path, fmt=None):
+    '''Storage format of the cleaned data in `path` - `fmt` if given, else the one recorded in its manifest (`STORAGE_FORMAT` if there is none)'''
+    if fmt is not None: return fmt
+    manifest = read_manifest(path)
+    return STORAGE_FORMAT if manifest is None else manifest['fmt']
+
+# Cell
+def persist_cleaned(path, split_name, cleaned_dfs, code_tables=None, fmt=STORAGE_FORMAT, start_rows=None):
+    '''Save cleaned EHR data to disk, record tables grouped by patient with their offsets - appended to saved tables if their `start_rows` are given'''
     csv_names = FILENAMES.copy()
     csv_names.insert(1,'patient_demographics')
+    append = start_rows is not None
 
     cleaned_dir = Path(f'{path}/cleaned/{split_name}')
     cleaned_dir.mkdir(parents=True, exist_ok=True)
 
-    cleaned_dfs = ray.get(cleaned_dfs)
-
     patients = cleaned_dfs[0]
     patients.reset_index(inplace=True)
-    patients.to_csv(f'{cleaned_dir}/patients.csv', index_label='indx')
+    if append: patients.index = patients.index + start_rows['patients']
+    write_table(patients, cleaned_dir, 'patients', fmt, index_label='indx', append=append)
 
+    cleaned_dfs = cleaned_dfs[:2] + [group_by_patient(df) for df in cleaned_dfs[2:]]
     for df, name in zip(cleaned_dfs[1:], csv_names[1:]):
-        df.to_csv(f'{cleaned_dir}/{name}.csv')
+        write_table(df, cleaned_dir, name, fmt, append=append)
+    rows = {name: len(df) for df, name in zip(cleaned_dfs, csv_names)}
+
+    offsets_dir = Path(f'{cleaned_dir}/offsets')
+    offsets_dir.mkdir(parents=True, exist_ok=True)
+    for df, name in zip(cleaned_dfs[2:], csv_names[2:]):
+        write_table(patient_offsets(df, start_rows[name] if append else 0), offsets_dir, name, fmt, append=append)
 
     print(f'Saved cleaned "{split_name}" data to {cleaned_dir}')
 
@@ -324,74 +631,302 @@ def persist_cleaned(path, split_name, cleaned_dfs, code_tables=None):
         codes_dir = Path(f'{cleaned_dir}/codes')
         codes_dir.mkdir(parents=True, exist_ok=True)
 
-        code_tables = ray.get(code_tables)
         for code_df,name in zip(code_tables, FILENAMES):
-            code_df.to_csv(f'{codes_dir}/code_{name}.csv', index_label='indx')
+            if append: code_df.index = pd.RangeIndex(start_rows[f'code_{name}'], start_rows[f'code_{name}'] + len(code_df))
+            write_table(code_df, codes_dir, f'code_{name}', fmt, index_label='indx', append=append)
+            rows[f'code_{name}'] = len(code_df)
         print(f'Saved vocab code tables to {codes_dir}')
-    return split_name
+    memory = memory_usage(cleaned_dfs, csv_names).to_dict()
+    return {'split': split_name, 'patients': patients['patient'].nunique(), 'rows': rows, 'memory': memory}
 
 # Cell
-def clean_raw_ehrdata(path, valid_pct, test_pct, conditions_dict, today=None):
-    '''Split, clean, preprocess raw EHR data & save cleaned data to disk'''
+def clean_raw_ehrdata(path, valid_pct, test_pct, conditions_dict, today=None, fmt=STORAGE_FORMAT, chunksize=None,
+                      executor='ray', max_workers=None, categorical=False, num_buckets=None):
+    '''Split (streaming if `chunksize` is given), clean & preprocess raw EHR data on `executor` and save cleaned data to disk -
+    out-of-core, a bucket of patients at a time, if `num_buckets` is given'''
 
     # split
-    split_ehr_dataset(path, valid_pct, test_pct)
-
-    # clean + preprocess
-    all_splits = []
-    for split in ['train', 'valid', 'test']:
-        split_path = f'{path}/raw_split/{split}'
-
-        if split == 'train': data_tables, code_tables = clean_preprocess_dataset.remote(split_path, True,  conditions_dict, today)
-        else               : data_tables, _           = clean_preprocess_dataset.remote(split_path, False, conditions_dict, today)
-
-        all_splits.append(data_tables)
-
-    # persist
-    remaining = []
-    remaining.append(persist_cleaned.remote(path, 'train', all_splits[0], code_tables))
-    remaining.append(persist_cleaned.remote(path, 'valid', all_splits[1]))
-    remaining.append(persist_cleaned.remote(path, 'test',  all_splits[2]))
-
-    while len(remaining) > 0:
-        ready, remaining = ray.wait(remaining)
-        for r in ready:
-            split_completed = ray.get(r)
-            print(f'Completed - {split_completed}')
-    return
+    if num_buckets is not None: bucket_pts = bucket_ehr_dataset(path, num_buckets, valid_pct, test_pct, chunksize=chunksize or 1_000_000, fmt=fmt)
+    elif chunksize is None    : split_ehr_dataset(path, valid_pct, test_pct, fmt=fmt)
+    else                      : stream_split_ehr_dataset(path, valid_pct, test_pct, chunksize=chunksize, fmt=fmt)
+
+    start = time.perf_counter()
+    executor = get_executor(executor, max_workers)
+    if num_buckets is not None:
+        # clean + preprocess + persist each bucket, then merge them
+        remaining = clean_ehr_buckets(path, bucket_pts, conditions_dict, today, fmt, executor, categorical)
+    else:
+        # clean + preprocess
+        all_splits = []
+        for split in ['train', 'valid', 'test']:
+            split_path = f'{path}/raw_split/{split}'
+
+            if split == 'train': data_tables, code_tables = clean_preprocess_dataset(split_path, True,  conditions_dict, today, fmt, executor, categorical)
+            else               : data_tables, _           = clean_preprocess_dataset(split_path, False, conditions_dict, today, fmt, executor, categorical)
+
+            all_splits.append(data_tables)
+
+        # persist
+        remaining = []
+        remaining.append(executor.submit(persist_cleaned, path, 'train', all_splits[0], code_tables, fmt))
+        remaining.append(executor.submit(persist_cleaned, path, 'valid', all_splits[1], None, fmt))
+        remaining.append(executor.submit(persist_cleaned, path, 'test',  all_splits[2], None, fmt))
+
+    split_mode = 'sample' if num_buckets is None and chunksize is None else 'stream' if num_buckets is None else 'buckets'
+    manifest = {'fmt': fmt, 'today': str(pd.Timestamp.today().date()) if today is None else today, 'conditions': conditions_dict,
+                'valid_pct': valid_pct, 'test_pct': test_pct, 'categorical': categorical, 'split_mode': split_mode, 'num_buckets': num_buckets,
+                'splits': {}, 'sources': hash_sources(f'{path}/raw_original')}
+    memory = {}
+    for summary in executor.as_completed(remaining):
+        print(f"Completed - {summary['split']}")
+        manifest['splits'][summary['split']] = {'patients': summary['patients'], 'patients_md5': split_patients_md5(path, summary['split'], fmt),
+                                                'rows': summary['rows']}
+        memory[summary['split']] = summary['memory']
+    write_manifest(path, manifest)
+    if num_buckets is not None: shutil.rmtree(f'{path}/buckets')
+    print(f'Memory usage (MB) of the cleaned tables:\n{pd.DataFrame(memory).round(2)}')
+
+    task_times = executor.task_times()
+    executor.shutdown()
+    print(f'Cleaned in {time.perf_counter() - start:.2f} secs with {type(executor).__name__}')
+    return task_times
 
 # Cell
-def load_cleaned_ehrdata(path):
-    '''Load cleaned, age-filtered EHR data'''
+def load_cleaned_ehrdata(path, splits=['train', 'valid', 'test'], columns=None, fmt=None, categorical=False):
+    '''Load cleaned, age-filtered EHR data - for the given `splits`, optionally only some `columns` per table & `categorical` code columns
+    (in the format the data was saved in, unless `fmt` is given)'''
+    fmt = cleaned_fmt(path, fmt)
 
     csv_names = FILENAMES.copy()
     csv_names.insert(1,'patient_demographics')
+    columns = {} if columns is None else columns
 
-    train_dfs = [pd.read_csv(f'{path}/cleaned/train/{fname}.csv', low_memory=False, index_col=0) for fname in csv_names]
-    valid_dfs = [pd.read_csv(f'{path}/cleaned/valid/{fname}.csv', low_memory=False, index_col=0) for fname in csv_names]
-    test_dfs  = [pd.read_csv(f'{path}/cleaned/test/{fname}.csv', low_memory=False, index_col=0) for fname in csv_names]
+    all_dfs = [[read_table(f'{path}/cleaned/{split}', fname, fmt, columns.get(fname), index_col=0) for fname in csv_names]
+               for split in splits]
+    if categorical: all_dfs = [[to_categorical(df) for df in dfs] for dfs in all_dfs]
 
-    return train_dfs, valid_dfs, test_dfs
+    return tuple(all_dfs)
 
 # Cell
-def load_ehr_vocabcodes(path):
+def load_ehr_vocabcodes(path, fmt=None):
     '''Load codes for vocabs'''
+    fmt = cleaned_fmt(path, fmt)
 
-    code_dfs = [pd.read_csv(f'{path}/cleaned/train/codes/code_{fname}.csv', low_memory=False, na_filter=False, index_col=0) for fname in FILENAMES]
+    code_dfs = [read_table(f'{path}/cleaned/train/codes', f'code_{fname}', fmt, index_col=0, na_filter=False) for fname in FILENAMES]
 
     return code_dfs
 
+# Cell
+def load_cleaned_offsets(path, splits=['train', 'valid', 'test'], fmt=None):
+    '''Load patient offsets of the record tables for the given `splits` - `None` for tables saved without offsets'''
+    fmt = cleaned_fmt(path, fmt)
+    offsets_exist = lambda split, fname: Path(f'{path}/cleaned/{split}/offsets/{fname}.{fmt}').exists()
+
+    all_offsets = [[read_table(f'{path}/cleaned/{split}/offsets', fname, fmt, index_col=0) if offsets_exist(split, fname) else None
+                    for fname in FILENAMES[1:]] for split in splits]
+
+    return tuple(all_offsets)
+
+# Cell
+class CleanedEhrData:
+    '''Lazily load cleaned EHR tables - a split's table is read on first access (optionally only some `columns`),
+    keeping at most `max_tables` tables in memory (the least recently used are dropped first)'''
+    table_names = ['patients', 'patient_demographics'] + FILENAMES[1:]
+
+    def __init__(self, path, columns=None, fmt=None, categorical=False, max_tables=None):
+        self.path, self.fmt, self.categorical, self.max_tables = path, cleaned_fmt(path, fmt), categorical, max_tables
+        self.columns = {} if columns is None else columns
+        self.tables = OrderedDict()
+
+    def __getitem__(self, key):
+        '''`data[split, table]` - `table` is a name or a position in `table_names`'''
+        split, name = key
+        if isinstance(name, int): name = self.table_names[name]
+        if (split, name) in self.tables:
+            self.tables.move_to_end((split, name))
+            return self.tables[split, name]
+
+        df = read_table(f'{self.path}/cleaned/{split}', name, self.fmt, self.columns.get(name), index_col=0)
+        if self.categorical: df = to_categorical(df)
+        self.tables[split, name] = df
+        if self.max_tables is not None:
+            while len(self.tables) > self.max_tables: self.tables.popitem(last=False)
+        return df
+
+    def split(self, split):
+        '''All tables of a split - in the same order as `load_cleaned_ehrdata`'''
+        return [self[split, name] for name in self.table_names]
+
+    def records(self, split):
+        '''`RecordStore`s of the record tables of a split, using their saved offsets'''
+        offsets, = load_cleaned_offsets(self.path, [split], self.fmt)
+        return [RecordStore(self[split, name], offs) for name, offs in zip(FILENAMES[1:], offsets)]
+
+    def evict(self, split=None):
+        '''Drop the tables of a `split` (or all tables) from memory'''
+        for key in [key for key in self.tables if split is None or key[0] == split]: del self.tables[key]
+
+    def __repr__(self): return f'{self.__class__.__name__}: {self.path}, in memory: {list(self.tables)}'
+
+# Cell
+def split_delta_ehr_dataset(path, delta_path, known_ptids, valid_pct=0.2, test_pct=0.2, random_state=1234, fmt=STORAGE_FORMAT):
+    '''Split new patients in `delta_path` & their records into train, valid, test by hashing patient ids and save - records of `known_ptids` are skipped'''
+    dfs = read_raw_ehrdata(delta_path)
+    pts = dfs[0]
+    pts.rename(str.lower, axis='columns', inplace=True)
+    pts = pts[~pts['id'].isin(set(known_ptids))]
+    pt_splits = pd.Series(hash_split_patients(pts['id'], valid_pct, test_pct, random_state), index=pts['id'].values)
+
+    split_dirs = [Path(f'{path}/raw_split_delta/{split}') for split in ['train', 'valid', 'test']]
+    shutil.rmtree(f'{path}/raw_split_delta', ignore_errors=True)
+    for d in split_dirs: d.mkdir(parents=True)
+
+    for df, name in zip([pts] + dfs[1:], FILENAMES):
+        split_ids = pt_splits.values if name == FILENAMES[0] else df['PATIENT'].map(pt_splits).values
+        counts = []
+        for i, d in enumerate(split_dirs):
+            split_df = df[split_ids == i]
+            write_table(split_df, d, name, fmt, index=False)
+            counts.append(len(split_df))
+        print(f'Split new {name} into:: Train: {counts[0]}, Valid: {counts[1]}, Test: {counts[2]} -- Skipped: {len(df) - sum(counts)}')
+    return [int((pt_splits == i).sum()) for i in range(3)]
+
+# Cell
+def clean_delta_ehrdata(path, delta_path, today=None, random_state=1234, executor='ray', max_workers=None):
+    '''Split, clean & preprocess only new patients in `delta_path` and append them to the cleaned data in `path`'''
+    manifest = read_manifest(path)
+    if manifest is None: raise FileNotFoundError(f'No manifest in {path}/cleaned - run `clean_raw_ehrdata` first')
+    sources = hash_sources(delta_path)
+    if set(sources.values()) <= set(manifest['sources'].values()):
+        print(f'All files in {delta_path} have already been processed')
+        return
+
+    # split
+    fmt, conditions_dict = manifest['fmt'], manifest['conditions']
+    today = manifest['today'] if today is None else today
+    known_ptids = pd.concat([read_table(f'{path}/cleaned/{split}', 'patients', fmt, columns=['patient'], index_col=0)['patient'] for split in manifest['splits']])
+    new_pts = split_delta_ehr_dataset(path, delta_path, known_ptids, manifest['valid_pct'], manifest['test_pct'], random_state, fmt)
+
+    # clean + preprocess + append
+    executor = get_executor(executor, max_workers)
+    remaining = []
+    for split, n_pts in zip(['train', 'valid', 'test'], new_pts):
+        if n_pts == 0: continue
+        is_train = split == 'train'
+        data_tables, code_tables = clean_preprocess_dataset(f'{path}/raw_split_delta/{split}', is_train, conditions_dict, today, fmt, executor,
+                                                            manifest.get('categorical', False))
+        remaining.append(executor.submit(persist_cleaned, path, split, data_tables, code_tables, fmt, manifest['splits'][split]['rows']))
+
+    for summary in executor.as_completed(remaining):
+        split = manifest['splits'][summary['split']]
+        split['patients'] += summary['patients']
+        split['rows'] = {name: split['rows'][name] + n for name, n in summary['rows'].items()}
+        split['patients_md5'] = split_patients_md5(path, summary['split'], fmt)
+        print(f"Appended {summary['patients']} new patients to {summary['split']}")
+    executor.shutdown()
+
+    manifest['sources'].update(sources)
+    write_manifest(path, manifest)
+
+# Cell
+def hash_bucket_patients(ptids, num_buckets):
+    '''Assign patient ids to `num_buckets` buckets deterministically, by hashing the ids'''
+    hashes = pd.util.hash_pandas_object(pd.Series(ptids), index=False).values
+    return (hashes % np.uint64(num_buckets)).astype(int)
+
+# Cell
+def bucket_ehr_dataset(path, num_buckets, valid_pct=0.2, test_pct=0.2, random_state=1234, chunksize=1_000_000, fmt=STORAGE_FORMAT):
+    '''Split EHR dataset into train, valid, test & each split into `num_buckets` buckets of patients and save - reading & writing each table in chunks'''
+    shutil.rmtree(f'{path}/buckets', ignore_errors=True)
+    split_dirs = [Path(f'{path}/buckets/{bucket:03d}/raw_split/{split}') for bucket in range(num_buckets) for split in ['train', 'valid', 'test']]
+    for d in split_dirs: d.mkdir(parents=True)
+
+    for name in FILENAMES:
+        writers = [TableWriter(d, name, fmt) for d in split_dirs]
+        total = 0
+        for chunk in pd.read_csv(f'{path}/raw_original/{name}.csv', dtype=str, chunksize=chunksize):
+            if name == FILENAMES[0]: chunk.rename(str.lower, axis='columns', inplace=True)
+            ptids = chunk['id' if name == FILENAMES[0] else 'PATIENT']
+            # sort rows by bucket & split (in the order of `split_dirs`), then append each writer's slice
+            keys = hash_bucket_patients(ptids, num_buckets) * 3 + hash_split_patients(ptids, valid_pct, test_pct, random_state)
+            order = np.argsort(keys, kind='stable')
+            bounds = np.searchsorted(keys[order], np.arange(len(writers) + 1))
+            chunk = chunk.iloc[order]
+            for writer, start, stop in zip(writers, bounds[:-1], bounds[1:]): writer.append(chunk.iloc[start:stop])
+            total += len(chunk)
+        counts = np.array([writer.close() for writer in writers]).reshape(num_buckets, 3)
+        n_train, n_valid, n_test = counts.sum(axis=0)
+        assert total == n_train+n_valid+n_test, f'Split failed {name}: {total} != {n_train}+{n_valid}+{n_test}'
+        print(f'Split {name} into {num_buckets} buckets of:: Train: {n_train}, Valid: {n_valid}, Test: {n_test} -- Largest bucket: {counts.sum(axis=1).max()}')
+        if name == FILENAMES[0]: bucket_pts = counts.tolist()
+
+    print(f'Saved bucketed train, valid & test data to {Path(f"{path}/buckets")}')
+    return bucket_pts
+
+# Cell
+def clean_bucket(bucket_path, split_name, conditions_dict, today=None, fmt=STORAGE_FORMAT, categorical=False):
+    '''Clean, preprocess & save a single split of a bucket - as one task, so only its summary leaves the worker'''
+    data_tables, code_tables = clean_preprocess_dataset(f'{bucket_path}/raw_split/{split_name}', split_name == 'train', conditions_dict, today, fmt,
+                                                        SerialExecutor(), categorical)
+    summary = persist_cleaned(bucket_path, split_name, data_tables, code_tables, fmt)
+    return {**summary, 'path': bucket_path}
+
+# Cell
+def merge_cleaned_buckets(path, split_name, bucket_summaries, fmt=STORAGE_FORMAT):
+    '''Concatenate a split's cleaned tables of all buckets into the cleaned data in `path` - reading one table of one bucket at a time'''
+    csv_names = FILENAMES.copy()
+    csv_names.insert(1,'patient_demographics')
+    # (sub directory, table, how it is renumbered to follow the rows of the previous buckets)
+    tables = [('', 'patients', 'index')] + [('', name, None) for name in csv_names[1:]] + [('offsets', name, 'offsets') for name in csv_names[2:]]
+    if split_name == 'train': tables.extend([('codes', f'code_{name}', 'index') for name in FILENAMES])
+
+    csv_kwargs = {'dtype': str, 'na_filter': False} # copy csv values as they are
+    for subdir, name, renumber in tables:
+        out_dir = Path(f'{path}/cleaned/{split_name}', subdir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        writer, start = TableWriter(out_dir, name, fmt, index=True), 0
+        for summary in bucket_summaries:
+            df = read_table(Path(summary['path'], 'cleaned', split_name, subdir), name, fmt, index_col=0, **csv_kwargs)
+            if renumber == 'index'  : df.index = pd.RangeIndex(start, start + len(df), name=df.index.name)
+            if renumber == 'offsets': df[['start', 'stop']] = df[['start', 'stop']].astype(int) + start
+            writer.append(df)
+            start += summary['rows'][name]
+        writer.close()
+    print(f'Merged cleaned "{split_name}" data of {len(bucket_summaries)} buckets to {Path(f"{path}/cleaned/{split_name}")}')
+
+    patients = sum(summary['patients'] for summary in bucket_summaries)
+    rows = {name: sum(summary['rows'][name] for summary in bucket_summaries) for name in bucket_summaries[0]['rows']}
+    memory = pd.DataFrame([summary['memory'] for summary in bucket_summaries]).sum().to_dict()
+    return {'split': split_name, 'patients': patients, 'rows': rows, 'memory': memory}
+
+# Cell
+def clean_ehr_buckets(path, bucket_pts, conditions_dict, today=None, fmt=STORAGE_FORMAT, executor=None, categorical=False):
+    '''Clean & preprocess every split of every bucket on `executor` & merge each split - returns `executor` handles to the summary of each split'''
+    executor = SerialExecutor() if executor is None else executor
+    remaining = []
+    for i, split in enumerate(['train', 'valid', 'test']):
+        # a split without patients in any bucket (e.g. `test_pct=0`) is cleaned from the empty tables of the first bucket,
+        # so it is saved as tables with all their columns & no rows - like an empty split cleaned in memory
+        buckets = [bucket for bucket, n_pts in enumerate(bucket_pts) if n_pts[i] > 0] or [0]
+        summaries = [executor.submit(clean_bucket, f'{path}/buckets/{bucket:03d}', split, conditions_dict, today, fmt, categorical)
+                     for bucket in buckets]
+        remaining.append(executor.submit(merge_cleaned_buckets, path, split, summaries, fmt))
+    return remaining
+
 # Cell
 
 def test_extract_ys(pt_dfs, cnd_dfs, conditions_dict=CONDITIONS):
     """Test for extract_ys function."""
+    labels = list(conditions_dict.keys())
+    start_codes = [f"{conditions_dict[label]}||START" for label in labels]
     for pts_df, cnds_df, split in zip(pt_dfs, cnd_dfs, ['train','valid','test']):
         print(f"Checking {split} dfs...")
-        for this_cnd in conditions_dict.keys():
-            code = f"{conditions_dict[this_cnd]}||START"
-            cnds_df_counts = len(cnds_df[cnds_df['code'] == code])
-            pts_df_counts = len(pts_df[pts_df[this_cnd] == 1])
-            assert cnds_df_counts == pts_df_counts, f"Error in {split} for {this_cnd} -- {cnds_df_counts} != {pts_df_counts}"
+        starts = cnds_df[cnds_df['code'].isin(start_codes)]
+        starts = pd.DataFrame({'patient': starts.index, 'code': starts['code'].values}).drop_duplicates()
+        cnds_df_counts = starts['code'].value_counts()
+        pts_df_counts = pts_df[labels].sum()
+        for this_cnd, code in zip(labels, start_codes):
+            assert cnds_df_counts.get(code, 0) == pts_df_counts[this_cnd], f"Error in {split} for {this_cnd} -- {cnds_df_counts.get(code, 0)} != {pts_df_counts[this_cnd]}"
 
         print(f"Tests passed for {split} - all condition counts match")
     return
@@ -402,10 +937,8 @@ def get_label_counts(pt_dfs, conditions_dict=CONDITIONS):
     """Get label counts in the given split of the dataset."""
     all_counts = []
     for pts_df, split in zip(pt_dfs, ['train','valid','test']):
-        split_counts = {}
-        for this_cnd in conditions_dict.keys():
-            split_counts[this_cnd] = len(pts_df[pts_df[this_cnd] == 1])
-        all_counts.append(split_counts)
+        split_counts = pts_df[list(conditions_dict.keys())].sum()
+        all_counts.append({this_cnd: int(count) for this_cnd, count in split_counts.items()})
 
     return all_counts
 
@@ -415,13 +948,12 @@ def test_cleaned_ehrdata(dataset_paths = [PATH_1K, PATH_10K, PATH_20K, PATH_100K
     """Loads and sanity checks cleaned data for all datasets."""
 
     for dataset_path in dataset_paths:
-        train_dfs, valid_dfs, test_dfs = load_cleaned_ehrdata(dataset_path)
-        code_dfs = load_ehr_vocabcodes(dataset_path)
-        pts_train, pts_valid, pts_test = train_dfs[0], valid_dfs[0], test_dfs[0]
-        cnd_train, cnd_valid, cnd_test = train_dfs[8], valid_dfs[8], test_dfs[8]
+        cleaned = CleanedEhrData(dataset_path, columns={'conditions': ['code']})
+        pt_dfs  = [cleaned[split, 'patients']   for split in ['train', 'valid', 'test']]
+        cnd_dfs = [cleaned[split, 'conditions'] for split in ['train', 'valid', 'test']]
         print("\n----------")
         print(f"Running tests for {dataset_path}")
-        test_extract_ys([pts_train, pts_valid, pts_test],[cnd_train, cnd_valid, cnd_test])
+        test_extract_ys(pt_dfs, cnd_dfs)
         print(f"Label counts")
-        for label_counts in get_label_counts([pts_train, pts_valid, pts_test]):
+        for label_counts in get_label_counts(pt_dfs):
             print(label_counts)
\ No newline at end of file
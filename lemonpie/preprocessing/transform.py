@@ -1,7 +1,10 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_preprocessing_transform.ipynb (unless otherwise specified).
 
-__all__ = ['collate_codes_offsts', 'get_codenums_offsts', 'get_demographics', 'Patient', 'get_pckl_dir', 'PatientList',
-           'cpu_cnt', 'create_all_ptlists', 'preprocess_ehr_dataset']
+__all__ = ['collate_codes_offsts', 'get_codenums_offsts', 'get_demographics', 'collate_all_codenums_offsts',
+           'get_all_demographics', 'Patient', 'PatientStore', 'PTSHARD_VERSION', 'get_pckl_dir', 'ptlist_cache_config',
+           'ptlist_cache_config_complete', 'ptlist_cache_key', 'ptlist_cache_dir', 'find_ptlist_cache',
+           'evict_ptlist_cache', 'PTLIST_CACHE_VERSION', 'PatientList', 'cpu_cnt', 'create_all_ptlists',
+           'preprocess_ehr_dataset']
 
 # Cell
 from ..basics import *
@@ -9,29 +12,31 @@ from .clean import *
 from .vocab import *
 from fastai.imports import *
 import torch.multiprocessing as multiprocessing
+import time
 
 # Cell
 def collate_codes_offsts(rec_df, age_start, age_stop, age_in_months=False):
     """Return a single patient's EmbeddingBag lookup codes and offsets for the given age span and age units"""
-    codes  = []
-    offsts = [0]
     age_span = age_stop - age_start
     if rec_df.empty:
-        codes = ['xxnone'] * age_span
-        offsts = list(range(age_span))
-    else:
-        for i in range(age_start, age_stop, 1):
-            if age_in_months: res = (rec_df.code[rec_df.age_months == i]).values
-            else            : res = (rec_df.code[rec_df.age == i]).values
-            if len(res) > 0:
-                codes.extend(res)
-                if i < age_stop - 1: offsts.append(offsts[-1] + len(res))
-            else:
-                codes.append('xxnone')
-                if i < age_stop - 1: offsts.append(offsts[-1] + 1)
+        return ["xxnone"] * age_span, list(range(age_span))
+
+    ages = (rec_df.age_months if age_in_months else rec_df.age).values
+    in_span = np.isin(ages, np.arange(age_start, age_stop))
+    periods = ages[in_span].astype(np.int64) - age_start
+    order = np.argsort(periods, kind="stable")  # by age, records of an age in order of rows
+    periods, codes = periods[order], np.asarray(rec_df.code.values, dtype=object)[in_span][order]
+
+    # each period holds its codes - or a single xxnone if nothing was recorded
+    counts = np.bincount(periods, minlength=age_span)
+    sizes = np.maximum(counts, 1)
+    offsts = np.cumsum(sizes) - sizes
+    res = np.full(sizes.sum(), "xxnone", dtype=object)
+    ranks = np.arange(len(periods)) - (np.cumsum(counts) - counts)[periods]
+    res[offsts[periods] + ranks] = codes
 
     assert len(offsts) == age_span
-    return codes, offsts
+    return res.tolist(), offsts.tolist()
 
 # Cell
 def get_codenums_offsts(rec_dfs, all_vocabs, age_start, age_stop, age_in_months):
@@ -77,6 +82,43 @@ def get_demographics(demograph_vector, demographics_vocabs, age_mean, age_std):
 
     return demographics, age
 
+# Cell
+def collate_all_codenums_offsts(rec_df, vocab, ptids, age_starts, age_range, age_in_months=False):
+    """Numericalized codes and EmbeddingBag offsets of a record table for all patients at once - the nums of the i-th patient (of `ptids`) are
+    `nums[bounds[i] : bounds[i + 1]]` with offsets `offsts[i]`"""
+    pt_nums = pd.Index(ptids).get_indexer(rec_df.index)
+    ages = (rec_df.age_months if age_in_months else rec_df.age).values
+    periods = ages - np.asarray(age_starts)[pt_nums]
+    in_span = (pt_nums >= 0) & (periods >= 0) & (periods < age_range) & (periods == np.floor(periods))
+    cells = pt_nums[in_span] * age_range + periods[in_span].astype(np.int64)
+    order = np.argsort(cells, kind="stable")  # by patient then age, records of an age in order of rows
+    cells, codes = cells[order], rec_df.code.values[in_span][order]
+
+    # each (patient, period) holds its codes - or a single xxnone if nothing was recorded
+    counts = np.bincount(cells, minlength=len(ptids) * age_range)
+    sizes = np.maximum(counts, 1)
+    starts = np.cumsum(sizes) - sizes
+    nums = np.full(sizes.sum(), vocab.numericalize(["xxnone"])[0], dtype=np.int64)
+    ranks = np.arange(len(cells)) - (np.cumsum(counts) - counts)[cells]
+    nums[starts[cells] + ranks] = vocab.numericalize_array(codes)
+
+    starts = starts.reshape(len(ptids), age_range)
+    bounds = np.append(starts[:, 0], len(nums))
+    return nums, starts - starts[:, :1], bounds
+
+# Cell
+def get_all_demographics(demographics_df, demographics_vocabs, age_mean, age_std):
+    """Numericalize demographics and normalize age for all patients (rows of `demographics_df`) at once"""
+    demographics_df = demographics_df.fillna("xxnone")
+    birthdates = pd.to_datetime(demographics_df.iloc[:, 0])
+    columns = [birthdates.dt.day, birthdates.dt.month, birthdates.dt.year]
+    columns.extend(demographics_df.iloc[:, i] for i in range(1, 9))
+    demographics = np.stack(
+        [vocab.numericalize_array(col.values) for vocab, col in zip(demographics_vocabs, columns)], axis=1
+    ).astype(np.int64)
+    ages = (demographics_df.iloc[:, 9].values - age_mean) / age_std
+    return demographics, ages
+
 # Cell
 class Patient:
     """Class defining a patient object that holds all numericalized / transformed data for a single patient"""
@@ -149,6 +191,34 @@ class Patient:
 
         return cls(codenums, offsts, demographics, age_now, birthdate, conditions, ptid)
 
+    @classmethod
+    def create_all(
+        cls,
+        patients,
+        demographics_df,
+        rec_dfs,
+        vocablist,
+        cnds,
+        age_start,
+        age_range,
+        start_is_date,
+        age_in_months,
+    ):
+        """Create patient objects for all patients (rows of `patients`) at once - see `PatientStore.create`"""
+        return list(
+            PatientStore.create(
+                patients,
+                demographics_df,
+                rec_dfs,
+                vocablist,
+                cnds,
+                age_start,
+                age_range,
+                start_is_date,
+                age_in_months,
+            )
+        )
+
     def pin_memory(self):
         """Call `torch.Tensor.pin_memory` for (all tensors of) this patient object"""
         if not self.obs_nums.is_pinned():
@@ -202,8 +272,191 @@ class Patient:
 
 
 # Cell
-def get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months):
-    """Util function to construct pickle dir name - for persisting transformed `PatientList`s"""
+PTSHARD_VERSION = 1
+
+
+class PatientStore:
+    """All patients of a `PatientList` as a struct of arrays - `Patient` objects are created on access"""
+
+    rec_types = ["obs", "alg", "crpl", "med", "img", "proc", "cnd", "imm"]
+
+    def __init__(self, nums, ptrs, offsts, demographics, ages_now, conditions, cnds, ptids, birthdates):
+        self.nums = [np.asarray(n, dtype=np.int32) for n in nums]
+        self.ptrs = [np.asarray(p, dtype=np.int64) for p in ptrs]
+        self.offsts = [np.asarray(o, dtype=np.int32) for o in offsts]
+        self.demographics = np.asarray(demographics, dtype=np.int32)
+        self.ages_now = np.asarray(ages_now, dtype=np.float64)
+        self.conditions, self.cnds = np.asarray(conditions), list(cnds)
+        self.ptids, self.birthdates = np.asarray(ptids, dtype=object), np.asarray(birthdates, dtype=object)
+
+    def __len__(self):
+        return len(self.ptids)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, idx):
+        """`Patient` object of patient `idx` (a list of them for a slice)"""
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        i = range(len(self))[idx]
+        nums = [nums[ptrs[i] : ptrs[i + 1]].astype(np.int64) for nums, ptrs in zip(self.nums, self.ptrs)]
+        offsts = [offsts[i].astype(np.int64) for offsts in self.offsts]
+        conditions = dict(zip(self.cnds, self.conditions[i]))
+        return Patient(
+            nums, offsts, self.demographics[i].astype(np.int64), self.ages_now[i], self.birthdates[i], conditions, self.ptids[i]
+        )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__} ({len(self)} patients, {sum(len(nums) for nums in self.nums)} nums)"
+
+    def __getstate__(self):
+        # a memory-mapped store is pickled (e.g. to `DataLoader` workers) as its shard, which is opened again when unpickled
+        if getattr(self, "shard_dir", None) is not None:
+            return {"shard_dir": self.shard_dir}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if "nums" not in state:
+            state = self.load(state["shard_dir"]).__dict__
+        self.__dict__.update(state)
+
+    def labels(self, labels):
+        """Matrix of `labels` (conditions) of all patients - a row per patient"""
+        return self.conditions[:, [self.cnds.index(label) for label in labels]].astype(float)
+
+    def save(self, shard_dir):
+        """Save as a shard - flat (memory-mappable) `.npy` arrays and a `patients.json` manifest"""
+        shard_dir = Path(shard_dir)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        birthdates_are_timestamps = len(self) > 0 and isinstance(self.birthdates[0], pd.Timestamp)
+        ids, strings, string_offsets = encode_strings(np.concatenate([self.ptids, self.birthdates.astype(str)]))
+        arrays = {"strings": strings, "string_offsets": string_offsets, "ptids": ids[: len(self)], "birthdates": ids[len(self) :]}
+        for rec_type, nums, ptrs, offsts in zip(self.rec_types, self.nums, self.ptrs, self.offsts):
+            arrays.update({f"{rec_type}_nums": nums, f"{rec_type}_ptrs": ptrs, f"{rec_type}_offsts": offsts})
+        arrays.update({"demographics": self.demographics, "ages_now": self.ages_now, "conditions": self.conditions})
+
+        for name, array in arrays.items():
+            np.save(shard_dir / f"{name}.npy", array)
+        manifest = {
+            "version": PTSHARD_VERSION,
+            "num_patients": len(self),
+            "cnds": self.cnds,
+            "birthdates_are_timestamps": birthdates_are_timestamps,
+            "arrays": list(arrays),
+        }
+        (shard_dir / "patients.json").write_text(json.dumps(manifest))
+
+    @classmethod
+    def load(cls, shard_dir, mmap=True):
+        """Load a store saved with `save` - `mmap` to memory-map its arrays (rather than reading them into memory)"""
+        shard_dir = Path(shard_dir)
+        manifest = json.loads((shard_dir / "patients.json").read_text())
+        if manifest["version"] != PTSHARD_VERSION:
+            raise Exception(
+                f'"{shard_dir}" has patient shard format version {manifest["version"]}, expected {PTSHARD_VERSION} - run pre-processing again.'
+            )
+        arrays = {name: np.load(shard_dir / f"{name}.npy", mmap_mode="r" if mmap else None) for name in manifest["arrays"]}
+        strings = decode_strings(arrays["strings"], arrays["string_offsets"])
+        birthdates = strings[arrays["birthdates"]]
+        if manifest["birthdates_are_timestamps"]:
+            birthdates = list(pd.to_datetime(birthdates))
+
+        store = cls(
+            [arrays[f"{rec_type}_nums"] for rec_type in cls.rec_types],
+            [arrays[f"{rec_type}_ptrs"] for rec_type in cls.rec_types],
+            [arrays[f"{rec_type}_offsts"] for rec_type in cls.rec_types],
+            arrays["demographics"],
+            arrays["ages_now"],
+            arrays["conditions"],
+            manifest["cnds"],
+            strings[arrays["ptids"]],
+            birthdates,
+        )
+        store.shard_dir = shard_dir if mmap else None
+        return store
+
+    @classmethod
+    def create(
+        cls,
+        patients,
+        demographics_df,
+        rec_dfs,
+        vocablist,
+        cnds,
+        age_start,
+        age_range,
+        start_is_date,
+        age_in_months,
+    ):
+        """Numericalize and collate all patients (rows of `patients`) at once - see `collate_all_codenums_offsts`"""
+        ptids, birthdates = patients["patient"].values, patients["birthdate"].values
+        if start_is_date:
+            birthdates = pd.to_datetime(birthdates)
+            unit = np.timedelta64(1, "M") if age_in_months else np.timedelta64(1, "Y")
+            age_starts = np.asarray((pd.to_datetime(age_start) - birthdates) // unit)
+            birthdates = list(birthdates)
+        else:
+            age_starts = np.full(len(ptids), age_start)
+
+        nums, offsts, ptrs = zip(
+            *[
+                collate_all_codenums_offsts(rec_df, vocab, ptids, age_starts, age_range, age_in_months)
+                for rec_df, vocab in zip(rec_dfs, vocablist.records_vocabs)
+            ]
+        )
+        demographics, ages_now = get_all_demographics(
+            demographics_df.loc[ptids],
+            vocablist.demographics_vocabs,
+            vocablist.age_mean,
+            vocablist.age_std,
+        )
+        conditions = np.stack([patients[cnd].values for cnd in cnds], axis=1) if cnds else np.zeros((len(ptids), 0), dtype=bool)
+        return cls(nums, ptrs, offsts, demographics, ages_now, conditions, cnds, ptids, birthdates)
+
+    @classmethod
+    def from_patients(cls, pts):
+        """Store of a list of `Patient` objects"""
+        cnds = list(pts[0].conditions) if len(pts) > 0 else []
+        nums, ptrs, offsts = [], [], []
+        for rec_type in cls.rec_types:
+            pt_nums = [np.asarray(getattr(pt, f"{rec_type}_nums")) for pt in pts]
+            nums.append(np.concatenate(pt_nums) if len(pts) > 0 else np.zeros(0))
+            ptrs.append(np.append(0, np.cumsum([len(n) for n in pt_nums])))
+            offsts.append(np.stack([np.asarray(getattr(pt, f"{rec_type}_offsts")) for pt in pts]) if len(pts) > 0 else np.zeros((0, 0)))
+        return cls(
+            nums,
+            ptrs,
+            offsts,
+            np.stack([np.asarray(pt.demographics) for pt in pts]) if len(pts) > 0 else np.zeros((0, 11)),
+            [np.asarray(pt.age_now)[0] for pt in pts],
+            np.array([[pt.conditions[cnd] for cnd in cnds] for pt in pts]).reshape(len(pts), len(cnds)),
+            cnds,
+            [pt.ptid for pt in pts],
+            [pt.birthdate for pt in pts],
+        )
+
+    @classmethod
+    def concat(cls, stores):
+        """Single store of all patients of `stores`"""
+        stores = [store for store in stores if len(store) > 0] or stores[:1]
+        return cls(
+            [np.concatenate([store.nums[r] for store in stores]) for r in range(len(cls.rec_types))],
+            [np.append(0, np.cumsum(np.concatenate([np.diff(store.ptrs[r]) for store in stores]))) for r in range(len(cls.rec_types))],
+            [np.concatenate([store.offsts[r] for store in stores]) for r in range(len(cls.rec_types))],
+            np.concatenate([store.demographics for store in stores]),
+            np.concatenate([store.ages_now for store in stores]),
+            np.concatenate([store.conditions for store in stores]),
+            stores[0].cnds,
+            np.concatenate([store.ptids for store in stores]),
+            np.concatenate([store.birthdates for store in stores]),
+        )
+
+# Cell
+def get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months, cache_key=None):
+    """Util function to construct pickle dir name - for persisting transformed `PatientList`s (in the cache, if `cache_key` is given)"""
+    if cache_key is not None:
+        return ptlist_cache_dir(path, cache_key) / split / f"modality_type_{modality_type}"
     dir_name = ""
     dir_name += "months" if age_in_months else "years"
     dir_name += f"_{age_start}_plus_{age_range}"
@@ -213,13 +466,122 @@ def get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months
     return pckl_dir
 
 
+# Cell
+PTLIST_CACHE_VERSION = 1
+
+
+def ptlist_cache_config(
+    path,
+    age_start,
+    age_range,
+    start_is_date,
+    age_in_months,
+    vocab_path=None,
+    modalities_file_path=None,
+):
+    """Everything the patient lists of the dataset at `path` depend on - the vocabs, the cleaned data (how its patients were split
+    & which patients are in each split) and the transform parameters"""
+    manifest = read_manifest(path)
+    manifest = {} if manifest is None else manifest
+    return {
+        "version": PTLIST_CACHE_VERSION,
+        "vocab_stamp": read_vocab_stamp(path if vocab_path is None else vocab_path),
+        "cleaned_md5": hashlib.md5(json.dumps(manifest, sort_keys=True).encode()).hexdigest() if manifest else None,
+        "split_mode": manifest.get("split_mode"),
+        "patients_md5": {split: info.get("patients_md5") for split, info in manifest.get("splits", {}).items()},
+        "age_start": str(age_start),
+        "age_range": int(age_range),
+        "start_is_date": bool(start_is_date),
+        "age_in_months": bool(age_in_months),
+        "modalities_md5": None
+        if modalities_file_path is None
+        else file_md5(f"{modalities_file_path}/modalities.csv"),
+    }
+
+
+def ptlist_cache_config_complete(config):
+    """Whether `config` identifies the vocabs & cleaned data - not without saved vocab arrays or a manifest of the cleaned data
+    (with its split), as patient lists cached before they changed could not be told apart"""
+    return (
+        config["vocab_stamp"] is not None
+        and config["cleaned_md5"] is not None
+        and config["split_mode"] is not None
+        and None not in config["patients_md5"].values()
+    )
+
+
+def ptlist_cache_key(config):
+    """Key of the patient lists created with `config` (see `ptlist_cache_config`) - a hash of all of it"""
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def ptlist_cache_dir(path, cache_key):
+    """Dir of the patient lists of the dataset at `path` cached with `cache_key`"""
+    return Path(f"{path}/processed/cache/{cache_key}")
+
+
+def find_ptlist_cache(
+    path,
+    age_start,
+    age_range,
+    start_is_date,
+    age_in_months,
+    vocab_path=None,
+    modalities_file_path=None,
+):
+    """Key of the cached patient lists created with the current vocabs & cleaned data of the dataset at `path`
+    and the given transform parameters & modalities - `None` if there are none"""
+    config = ptlist_cache_config(
+        path, age_start, age_range, start_is_date, age_in_months, vocab_path, modalities_file_path
+    )
+    if not ptlist_cache_config_complete(config):
+        return None
+    matches = [
+        config_file
+        for config_file in Path(f"{path}/processed/cache").glob("*/cache.json")
+        if json.loads(config_file.read_text()) == config
+    ]
+    if len(matches) > 1:
+        raise Exception(
+            f'{len(matches)} cached patient lists in "{path}/processed/cache" match the same config - delete them and create them again.'
+        )
+    if len(matches) == 0:
+        return None
+    matches[0].touch()  # used
+    return matches[0].parent.name
+
+
+def evict_ptlist_cache(path, budget, keep=()):
+    """Delete the least recently used cached patient lists of the dataset at `path` until all of them take up at most `budget` bytes -
+    never those with keys in `keep`, returns the bytes taken up by those left"""
+    config_files = sorted(Path(f"{path}/processed/cache").glob("*/cache.json"), key=lambda f: f.stat().st_mtime)
+    sizes = [sum(f.stat().st_size for f in config_file.parent.rglob("*") if f.is_file()) for config_file in config_files]
+    total = sum(sizes)
+    for config_file, size in zip(config_files, sizes):
+        if total <= budget:
+            break
+        if config_file.parent.name in keep:
+            continue
+        shutil.rmtree(config_file.parent)
+        total -= size
+        print(f"Evicted cached patient lists {config_file.parent} ({size / 2**20:.1f} MB)")
+    return total
+
 # Cell
 multiprocessing.set_sharing_strategy("file_system")
 cpu_cnt = int(multiprocessing.cpu_count())
 
+# data shared by all chunks of patients transformed by a `PatientList.create_save` worker process
+_pts_worker_data = {}
+
+
+def _init_pts_worker(all_dfs, vocablist):
+    """Initialize a worker process once with the data shared by all chunks - inherited (not pickled) when processes are forked"""
+    _pts_worker_data.update(all_dfs=all_dfs, vocablist=vocablist)
+
 
 class PatientList:
-    """A class to hold a list of `Patient` objects"""
+    """A class to hold a list of `Patient` objects (or a `PatientStore` of them)"""
 
     def __init__(
         self, pts, path, split, age_start, age_range, start_is_date, age_in_months
@@ -242,7 +604,7 @@ class PatientList:
             return self.items[idx]
         if isinstance(idx[0], bool):
             assert len(idx) == len(self)  # bool mask
-            return [o for m, o in zip(idx, self.items) if m]
+            return [self.items[i] for i, m in enumerate(idx) if m]
         return [self.items[i] for i in idx]
 
     def __repr__(self):
@@ -267,8 +629,12 @@ class PatientList:
         age_in_months,
         verbose,
     ):
-        """Parallelized function to run on one core and transform a single chunk of patients and save"""
+        """Parallelized function to run on one core and transform a single chunk of patients and save -
+        `all_dfs` and `vocablist` are those the worker process was initialized with, if not given"""
+        if all_dfs is None:
+            all_dfs, vocablist = _pts_worker_data["all_dfs"], _pts_worker_data["vocablist"]
 
+        start = time.time()
         pts = []
         for indx in indx_chnk:
             thispt = all_dfs[0].iloc[indx]
@@ -278,12 +644,7 @@ class PatientList:
             for cnd in cnds:
                 conditions[cnd] = thispt[cnd]
 
-            rec_dfs = []
-            for rec_df in all_dfs[2:]:
-                try:
-                    rec_dfs.append(rec_df.loc[[ptid]])
-                except KeyError:
-                    rec_dfs.append(pd.DataFrame())
+            rec_dfs = [rec_store[ptid] for rec_store in all_dfs[2:]]
 
             demograph = all_dfs[1].loc[ptid]
 
@@ -306,10 +667,12 @@ class PatientList:
             f"{pckl_dir}/patients_{indx_chnk[0]}_{indx_chnk[-1]}.ptlist", "wb"
         ) as pckl_f:
             pickle.dump(pts, pckl_f)
+        unknown_codes.flush()
 
         if verbose:
+            secs = max(time.time() - start, 1e-6)
             print(
-                f"{multiprocessing.current_process().name}-- completed {len(indx_chnk)} patients"
+                f"{multiprocessing.current_process().name}-- completed {len(indx_chnk)} patients in {secs:.2f} secs ({len(indx_chnk) / secs:.1f} patients/sec)"
             )
         return len(pts)
 
@@ -324,9 +687,18 @@ class PatientList:
         start_is_date,
         age_in_months,
         verbose=False,
+        vectorized=False,
+        memmap=False,
+        chnk_sz=None,
     ):
-        """Function to parellelize (based on available CPU cores) transformation for all patients in given dataset and save `PatientList` object"""
+        """Function to parellelize (based on available CPU cores) transformation for all patients in given dataset and save `PatientList` object -
+        or, if `vectorized`, to transform all patients at once and save them as a single `PatientStore` (see `PatientStore.create`).
+        If `memmap`, all patients are saved as a single shard of memory-mappable arrays instead (see `PatientStore.save`).
+        Patients are transformed in chunks of `chnk_sz` patients - by default 4 chunks per process, for load balancing"""
         pckl_dir.mkdir(parents=True, exist_ok=True)
+        all_dfs = all_dfs[:2] + [
+            df if isinstance(df, RecordStore) else RecordStore(df) for df in all_dfs[2:]
+        ]
         indx_chnks = []
 
         patients_df = all_dfs[0]
@@ -337,43 +709,119 @@ class PatientList:
 
         total_pts = len(patients_df)
         all_indxs = np.arange(total_pts)
-        chnk_sz = max( (total_pts // (cpu_cnt - 1)), 1)
+        if chnk_sz is None:
+            chnk_sz = max(total_pts // (4 * cpu_cnt), 1)
 
         for i in range(0, total_pts, chnk_sz):
             indx_chnks.append(list(all_indxs[i : i + chnk_sz]))
 
-        pool = multiprocessing.Pool(processes=cpu_cnt)
-        parallelize = partial(
-            cls._create_pts_chunk,
-            all_dfs=all_dfs,
-            vocablist=vocablist,
-            cnds=cnds,
-            pckl_dir=pckl_dir,
-            age_start=age_start,
-            age_range=age_range,
-            start_is_date=start_is_date,
-            age_in_months=age_in_months,
-            verbose=verbose,
-        )
-        all_chunks = pool.map(parallelize, indx_chnks)
-        pool.close()
+        if vectorized:
+            store = PatientStore.create(
+                patients_df,
+                all_dfs[1],
+                [rec_store.df for rec_store in all_dfs[2:]],
+                vocablist,
+                cnds,
+                age_start,
+                age_range,
+                start_is_date,
+                age_in_months,
+            )
+            all_chunks = [len(store)]
+            unknown_codes.flush()
+        else:
+            # workers get the data once, each task only the indexes of a chunk
+            pool = multiprocessing.Pool(
+                processes=cpu_cnt,
+                initializer=_init_pts_worker,
+                initargs=(all_dfs, vocablist),
+            )
+            parallelize = partial(
+                cls._create_pts_chunk,
+                all_dfs=None,
+                vocablist=None,
+                cnds=cnds,
+                pckl_dir=pckl_dir,
+                age_start=age_start,
+                age_range=age_range,
+                start_is_date=start_is_date,
+                age_in_months=age_in_months,
+                verbose=verbose,
+            )
+            all_chunks = list(pool.imap_unordered(parallelize, indx_chnks))
+            pool.close()
+            pool.join()
+
+            if memmap:
+                # gather the chunks saved by each process into a single store
+                pts = []
+                for indx_chnk in indx_chnks:
+                    chnk_file = pckl_dir / f"patients_{indx_chnk[0]}_{indx_chnk[-1]}.ptlist"
+                    with open(chnk_file, "rb") as infile:
+                        pts.extend(pickle.load(infile))
+                    chnk_file.unlink()
+                store = PatientStore.from_patients(pts)
+
+        if (vectorized or memmap) and total_pts > 0:
+            if memmap:
+                store.save(pckl_dir / f"patients_0_{total_pts - 1}.ptshard")
+            else:
+                with open(
+                    f"{pckl_dir}/patients_0_{total_pts - 1}.ptstore", "wb"
+                ) as pckl_f:
+                    pickle.dump(store, pckl_f)
+
+        # stamp of the vocabs used, checked when loading
+        stamp_file = pckl_dir / "vocab.stamp"
+        if getattr(vocablist, "stamp", None) is not None:
+            stamp_file.write_text(vocablist.stamp)
+        elif stamp_file.exists():
+            stamp_file.unlink()
 
         print(
             f"{sum(all_chunks)} total patients completed, saved patient list to {pckl_dir}"
         )
 
     @classmethod
-    def load(cls, path, split, modality_type, age_start, age_range, start_is_date, age_in_months):
-        """Load previously created `PatientList` object"""
-        pckl_dir = get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months)
+    def load(
+        cls,
+        path,
+        split,
+        modality_type,
+        age_start,
+        age_range,
+        start_is_date,
+        age_in_months,
+        vocab_stamp=None,
+        as_store=False,
+        cache_key=None,
+    ):
+        """Load previously created `PatientList` object - checking it was created with the vocabs of `vocab_stamp` (if given).
+        Patients saved as a `PatientStore` (or all patients, if `as_store`) are loaded into a single `PatientStore` -
+        a shard saved with `memmap` is memory-mapped, unless loaded along with other files"""
+        pckl_dir = get_pckl_dir(path, split, modality_type, age_start, age_range, age_in_months, cache_key)
         if not pckl_dir.exists():
             raise Exception(
                 f'"{pckl_dir}" does not exist, run pre-processing to create that dataset first.'
             )
-        ptlist = []
+        stamp_file = pckl_dir / "vocab.stamp"
+        if vocab_stamp is not None and stamp_file.exists() and stamp_file.read_text() != vocab_stamp:
+            raise Exception(
+                f'"{pckl_dir}" was created with different vocabs, run pre-processing again to re-create it.'
+            )
+        ptlist, stores = [], []
         for file in Path(pckl_dir).glob("*.ptlist"):
             with open(file, "rb") as infile:
                 ptlist.extend(pickle.load(infile))
+        for file in sorted(Path(pckl_dir).glob("*.ptstore")):
+            with open(file, "rb") as infile:
+                stores.append(pickle.load(infile))
+        for shard_dir in sorted(Path(pckl_dir).glob("*.ptshard")):
+            stores.append(PatientStore.load(shard_dir))
+        if len(stores) > 0 or as_store:
+            if len(ptlist) > 0 or len(stores) == 0:
+                stores.append(PatientStore.from_patients(ptlist))
+            ptlist = stores[0] if len(stores) == 1 else PatientStore.concat(stores)
 
         return cls(
             ptlist, path, split, age_start, age_range, start_is_date, age_in_months
@@ -391,19 +839,46 @@ def create_all_ptlists(
     modalities_file_path: str = None,
     verbose: bool = False,
     delete_existing: bool = True,
+    vectorized: bool = False,
+    memmap: bool = False,
+    cache: bool = False,
+    cache_budget: int = None,
 ):
-    """Create and save `PatientList`s for train, valid and test given dataset path"""
+    """Create and save `PatientList`s for train, valid and test given dataset path -
+    if `cache`, in the cache (reusing those cached with the same key, evicting others to stay within `cache_budget` bytes) and return their key"""
+
+    cache_key = None
+    if cache:
+        config = ptlist_cache_config(
+            path, age_start, age_range, start_is_date, age_in_months, vocab_path, modalities_file_path
+        )
+        if not ptlist_cache_config_complete(config):
+            print(f"No vocab arrays or no manifest of the cleaned data (with its split) for {path} - patient lists are not cached")
+            cache = False
+    if cache:
+        cache_key = ptlist_cache_key(config)
+        cache_dir = ptlist_cache_dir(path, cache_key)
+        if (cache_dir / "cache.json").exists():
+            (cache_dir / "cache.json").touch()  # used
+            print(f"Reusing patient lists created with the same vocabs, cleaned data & parameters in {cache_dir}")
+            return cache_key
+        if cache_dir.exists():  # left incomplete
+            shutil.rmtree(cache_dir)
 
     if vocab_path is None:
         vocab_path = path
-    all_dfs_splits = load_cleaned_ehrdata(path)  # train_dfs, valid_dfs, test_dfs
+    # only the columns used to create patients, loaded one split at a time
+    rec_columns = {name: ["code", "age", "age_months"] for name in FILENAMES[1:]}
+    cleaned = CleanedEhrData(path, columns=rec_columns)
     splits = ["train", "valid", "test"]
     vocablist = EhrVocabList.load(vocab_path)
     if modalities_file_path is not None:
         modalities = pd.read_csv(f"{modalities_file_path}/modalities.csv")
         ptids_by_modality = modalities.groupby(["type"])["id"]
 
-    for all_dfs, split in zip(all_dfs_splits, splits):
+    for split in splits:
+        all_dfs = [cleaned[split, "patients"], cleaned[split, "patient_demographics"]]
+        all_dfs.extend(cleaned.records(split))
         if modalities_file_path is not None:
             # Do for each modality_type
             for mod_type, ptids in ptids_by_modality:
@@ -415,11 +890,14 @@ def create_all_ptlists(
                 mod_type_all_dfs.extend(all_dfs[1:])
 
                 pckl_dir = get_pckl_dir(
-                    path, split, mod_type, age_start, age_range, age_in_months
+                    path, split, mod_type, age_start, age_range, age_in_months, cache_key
                 )
                 if delete_existing:
-                    for file in Path(pckl_dir).glob("*.ptlist"):
-                        file.unlink()
+                    for file in Path(pckl_dir).glob("patients_*"):
+                        if file.is_dir():
+                            shutil.rmtree(file)
+                        else:
+                            file.unlink()
                 PatientList.create_save(
                     mod_type_all_dfs,
                     vocablist,
@@ -429,13 +907,18 @@ def create_all_ptlists(
                     start_is_date,
                     age_in_months,
                     verbose,
+                    vectorized,
+                    memmap,
                 )
         else:
             # do once with moality_type = 0 (for EHR only)
-            pckl_dir = get_pckl_dir(path, split, 0, age_start, age_range, age_in_months)
+            pckl_dir = get_pckl_dir(path, split, 0, age_start, age_range, age_in_months, cache_key)
             if delete_existing:
-                for file in Path(pckl_dir).glob("*.ptlist"):
-                    file.unlink()
+                for file in Path(pckl_dir).glob("patients_*"):
+                    if file.is_dir():
+                        shutil.rmtree(file)
+                    else:
+                        file.unlink()
             PatientList.create_save(
                 all_dfs,
                 vocablist,
@@ -445,7 +928,18 @@ def create_all_ptlists(
                 start_is_date,
                 age_in_months,
                 verbose,
+                vectorized,
+                memmap,
             )
+        del all_dfs
+        cleaned.evict(split)
+
+    if cache:
+        # written last, marks the cached patient lists as complete
+        (cache_dir / "cache.json").write_text(json.dumps(config))
+        if cache_budget is not None:
+            evict_ptlist_cache(path, cache_budget, keep=[cache_key])
+        return cache_key
 
 
 # Cell
@@ -460,16 +954,35 @@ def preprocess_ehr_dataset(
     valid_pct=0.2,
     test_pct=0.2,
     obs_vocab_buckets=5,
+    obs_vocab_bucketing="linspace",
+    min_freq=1,
+    max_size=None,
+    hash_buckets=0,
     vocab_path=None,
     modalities_file_path=None,
     from_raw_data=False,
+    executor="ray",
+    num_buckets=None,
+    vectorized=False,
+    memmap=False,
+    cache=False,
+    cache_budget=None,
 ):
     """Do all preprocessing - split, clean raw data; create vocab lists; create patient lists"""
     if from_raw_data:
         print("------------ Splitting and cleaning raw dataset ------------")
-        clean_raw_ehrdata(path, valid_pct, test_pct, conditions_dict, today)
+        clean_raw_ehrdata(
+            path, valid_pct, test_pct, conditions_dict, today, executor=executor, num_buckets=num_buckets
+        )
         print("------------ Creating vocab lists ------------")
-        EhrVocabList.create(path, num_buckets=obs_vocab_buckets).save()
+        EhrVocabList.create(
+            path,
+            num_buckets=obs_vocab_buckets,
+            bucketing=obs_vocab_bucketing,
+            min_freq=min_freq,
+            max_size=max_size,
+            hash_buckets=hash_buckets,
+        ).save()
     else:
         print("Data is pre-cleaned; skipping Cleaning, Splitting & Vocab-creation")
 
@@ -482,4 +995,8 @@ def preprocess_ehr_dataset(
         age_in_months=age_in_months,
         vocab_path=vocab_path,
         modalities_file_path=modalities_file_path,
+        vectorized=vectorized,
+        memmap=memmap,
+        cache=cache,
+        cache_budget=cache_budget,
     )
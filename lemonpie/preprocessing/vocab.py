@@ -1,12 +1,16 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_preprocessing_vocab.ipynb (unless otherwise specified).
 
-__all__ = ['multiple_of_8', 'EhrVocab', 'ObsVocab', 'EhrVocabList', 'get_all_emb_dims']
+__all__ = ['multiple_of_8', 'prune_codes', 'hash_codes', 'UnknownCodes', 'unknown_codes', 'EhrVocab', 'ObsVocab',
+           'encode_strings', 'decode_strings', 'read_vocab_stamp', 'VOCAB_VERSION', 'VOCAB_ARRAYS', 'VocabDescs',
+           'EhrVocabList', 'get_all_emb_dims', 'get_emb_params']
 
 # Cell
 from ..basics import *
 from .clean import *
 from fastai.imports import *
 from datetime import date
+import atexit, hashlib
+from collections.abc import Mapping
 
 # Cell
 def multiple_of_8(orig):
@@ -20,41 +24,113 @@ def multiple_of_8(orig):
 
     return pad, opt
 
+# Cell
+def prune_codes(codes_df, min_freq=1, max_size=None, col='code'):
+    '''Rows of codes seen at least `min_freq` times - of only the `max_size` most frequent codes, if given (equally frequent in order of appearance)'''
+    if min_freq <= 1 and max_size is None: return codes_df
+    ids, uniqs = pd.factorize(codes_df[col])
+    counts = np.bincount(ids[ids >= 0], minlength=len(uniqs))
+    keep = counts >= min_freq
+    if max_size is not None: keep[np.argsort(-counts, kind='stable')[max_size:]] = False
+    return codes_df[np.append(keep, False)[ids]]
+
+# Cell
+def hash_codes(codes, num_buckets):
+    '''Bucket (in `[0, num_buckets)`) of each code - a stable hash of the code string'''
+    keys = np.array([str(code) for code in codes], dtype=object)
+    return (pd.util.hash_array(keys) % num_buckets).astype(np.int32)
+
+# Cell
+class UnknownCodes():
+    '''Buffer of unknown codes (& their counts) per vocab - written to the numericalize exceptions log on `flush()`'''
+    def __init__(self): self.counts, self.pid = defaultdict(Counter), os.getpid()
+
+    def _check_pid(self):
+        if self.pid != os.getpid(): self.counts, self.pid = defaultdict(Counter), os.getpid()
+
+    def add(self, vocab, codes, log_dir='default_log_store'):
+        '''Count unknown `codes` of `vocab`, to be logged in `log_dir`'''
+        self._check_pid()
+        log_dir = LOG_STORE if log_dir=='default_log_store' else log_dir
+        self.counts[log_dir, getattr(vocab, 'name', type(vocab).__name__)].update(codes)
+
+    def __len__(self):
+        self._check_pid()
+        return sum(sum(counts.values()) for counts in self.counts.values())
+
+    def flush(self):
+        '''Append all buffered codes to the day's log(s) - a single write per log - and empty the buffer'''
+        self._check_pid()
+        today = date.today().strftime("%Y-%m-%d")
+        logs = defaultdict(list)
+        for (log_dir, name), counts in self.counts.items():
+            logs[log_dir].extend(f'\ncode in {name}: {code} (x{count})' for code, count in counts.items())
+        for log_dir, lines in logs.items():
+            if not os.path.isdir(log_dir): os.makedirs(log_dir, exist_ok=True)
+            with open(f'{log_dir}/{today}_numericalize_exceptions.log', 'a') as log: log.write(''.join(lines))
+        self.counts.clear()
+
+# Cell
+unknown_codes = UnknownCodes()
+atexit.register(unknown_codes.flush)
+
 # Cell
 class EhrVocab():
     '''Vocab class for most EHR datatypes'''
-    def __init__(self, itoc, ctoi, ctod=None):
+    def __init__(self, itoc, ctoi, ctod=None, name=None):
         self.itoc = itoc
         self.ctoi = ctoi
         if ctod is not None: self.ctod = ctod
+        if name is not None: self.name = name
         self.vocab_size = len(self.itoc)
+        self._build_index()
+
+    def _build_index(self):
+        '''Index of all codes (& their indices) to numericalize arrays of codes - and the rows of hash buckets for unknown codes, if any'''
+        self.code_index, self.code_nums = pd.Index(list(self.ctoi.keys())), np.array(list(self.ctoi.values()), dtype=np.int32)
+        self.hash_start, self.hash_buckets = self.ctoi.get('xxhash0'), 0
+        while f'xxhash{self.hash_buckets}' in self.ctoi: self.hash_buckets += 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for index in ['code_index', 'code_nums', 'hash_start', 'hash_buckets', 'text_arrays']: state.pop(index, None)
+        return state
+
+    def __setstate__(self, state):
+        '''Index is rebuilt on load (also for vocabs pickled without one)'''
+        self.__dict__.update(state)
+        self._build_index()
 
     @classmethod
-    def create(cls, codes_df):
-        '''Create vocab object (itoc, ctoi and maybe ctod) from the codes df'''
+    def create(cls, codes_df, name=None, min_freq=1, max_size=None, hash_buckets=0):
+        '''Create vocab object (itoc, ctoi and maybe ctod) from the codes df - rare codes (see `prune_codes`) are left out,
+        unknown codes are numericalized to one of `hash_buckets` rows (if any) rather than `xxunk`'''
         desc_exists = 'desc' in codes_df.columns
-        codes_df = codes_df.astype({'code':'str'})
+        codes_df = prune_codes(codes_df.astype({'code':'str'}), min_freq, max_size)
         itoc = list(codes_df.code.unique())  #old --> list(set(codes_df.code))
         itoc.insert(0,'xxnone')
         itoc.insert(1,'xxunk')
 
         orig_len = len(itoc)
-        amp_pad_sz, _ = multiple_of_8(orig_len)
+        itoc.extend([f'xxhash{i}' for i in range(hash_buckets)])
+        amp_pad_sz, _ = multiple_of_8(len(itoc))
         itoc.extend(['xxamp' for _ in range(amp_pad_sz)])
 
         ctoi = {code: i for i, code in enumerate(itoc)}
 
         if desc_exists:
-            codes_df.set_index('code', inplace=True)
             ctod = {}
             ctod[itoc[0]] = "Nothing recorded"
             ctod[itoc[1]] = "Unknown"
-            for code in itoc[2:orig_len]:
-                ctod[code] = set(codes_df.loc[code].desc)
-            for code in itoc[orig_len:]:
+            # unique descriptions of all codes in one pass
+            code_descs = codes_df.drop_duplicates(['code', 'desc'])
+            for code, desc in zip(code_descs.code, code_descs.desc): ctod.setdefault(code, set()).add(desc)
+            for code in itoc[orig_len:orig_len+hash_buckets]:
+                ctod[code] = "Unknown (hashed)"
+            for code in itoc[orig_len+hash_buckets:]:
                 ctod[code] = "Padding for AMP"
 
-        return cls(itoc, ctoi, ctod) if desc_exists else cls(itoc, ctoi)
+        return cls(itoc, ctoi, ctod, name) if desc_exists else cls(itoc, ctoi, name=name)
 
     def get_emb_dims(self, αd=0.5736):
         '''Get embedding dimensions'''
@@ -65,28 +141,39 @@ class EhrVocab():
 
     def numericalize(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
         '''Lookup and return indices for codes'''
-
-        if log_excep:
-            today = date.today().strftime("%Y-%m-%d")
-            log_dir = LOG_STORE if log_dir=='default_log_store' else log_dir
-            if not os.path.isdir(log_dir): os.mkdir(log_dir)
-            logfile = f'{log_dir}/{today}_numericalize_exceptions.log'
-
         res = []
         try:
             res = [self.ctoi[str(code)] for code in codes] #no big performance benefit
         except KeyError:
+            res, unknown, unknown_pos = [], [], []
             for code in codes:
                 try:
                     res.append(self.ctoi[str(code)])
                 except KeyError:
                     res.append(self.ctoi['xxunk'])
-                    if log_excep:
-                        with open(logfile, 'a') as log:
-                            log.write(f'\ncode: {code}')
+                    unknown.append(code)
+                    unknown_pos.append(len(res) - 1)
+            if self.hash_buckets > 0:
+                for i, num in zip(unknown_pos, self.hash_start + hash_codes(unknown, self.hash_buckets)): res[i] = int(num)
+            if log_excep: unknown_codes.add(self, unknown, log_dir)
 
         return res
 
+    def numericalize_array(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
+        '''Lookup indices for a whole array of codes (list, numpy, pandas or arrow) at once - returns an `int32` array'''
+        if hasattr(codes, 'to_pandas'): codes = codes.to_pandas()
+        nums, uniqs = pd.factorize(pd.Series(codes)) # missing codes are -1, looked up as 'nan' like `str(code)` does
+        keys = [str(code) for code in uniqs] + ['nan']
+        indexer = self.code_index.get_indexer(keys)
+        uniq_nums = np.where(indexer == -1, self.ctoi['xxunk'], self.code_nums[indexer]).astype(np.int32)
+        if self.hash_buckets > 0:
+            uniq_nums[indexer == -1] = self.hash_start + hash_codes(np.array(keys, dtype=object)[indexer == -1], self.hash_buckets)
+
+        if log_excep and (indexer == -1).any():
+            unknown_codes.add(self, np.asarray(codes, dtype=object)[(indexer == -1)[nums]], log_dir)
+
+        return uniq_nums[nums]
+
     def textify(self, indxs):
         '''Lookup and return descriptions for codes'''
         if hasattr(self, 'ctod'):
@@ -95,89 +182,226 @@ class EhrVocab():
             res = [ (self.itoc[i]) for i in indxs ]
         return res
 
+    def _text_arrays(self):
+        '''Codes (& descriptions) of all indices as arrays to textify arrays of indices - built on first use'''
+        if not hasattr(self, 'text_arrays'):
+            codes, descs = np.array(self.itoc, dtype=object), None
+            if hasattr(self, 'ctod'):
+                descs = np.empty(len(self.itoc), dtype=object)
+                for i, code in enumerate(self.itoc): descs[i] = self.ctod[code]
+            self.text_arrays = codes, descs
+        return self.text_arrays
+
+    def textify_array(self, indxs):
+        '''Lookup codes (& descriptions) for a whole array of indices (list, numpy or tensor) at once - returns a DataFrame with a row per index'''
+        codes, descs = self._text_arrays()
+        indxs = np.asarray(indxs, dtype=np.int64)
+        if descs is None: return pd.DataFrame({'code': codes[indxs]})
+        else:             return pd.DataFrame({'code': codes[indxs], 'desc': descs[indxs]})
+
 # Cell
 class ObsVocab (EhrVocab):
     '''Special Vocab class for Observation codes'''
+    name = 'observations'
+
     def __init__(self, vocab_df):
         self.vocab_df = vocab_df
         self.vocab_size = len(vocab_df)
+        self._build_index()
+
+    def _build_index(self):
+        '''Index `vocab_df` - sorted bucket values & their rows for each numeric (code, units) and a row for each other code'''
+        numerics = self.vocab_df[self.vocab_df['type'] == 'numeric']
+        groups, values = numerics.groupby(['code', 'units'], sort=False).ngroup().values, numerics['value'].values.astype(float)
+        order = np.lexsort((values, groups)) # by (code, units) then value, equal values in order of rows
+        bounds = np.flatnonzero(np.diff(groups[order])) + 1
+        keys = numerics[['code', 'units']].drop_duplicates()
+        self.numeric_index = dict(zip(zip(keys['code'], keys['units']),
+                                      zip(np.split(values[order], bounds), np.split(numerics.index.values[order], bounds))))
+
+        others = self.vocab_df[self.vocab_df['type'] != 'numeric']
+        keys = zip(others['code'], others['value'], others['units'], others['type'])
+        self.other_index = {}
+        for key, row in zip(keys, others.index): self.other_index.setdefault(key, row)
+        self.special_index = {code: self.vocab_df.index[self.vocab_df['code'] == code][0] for code in ['xxnone', 'xxunk']}
+        hashed = np.flatnonzero(self.vocab_df['type'].values == 'xxhash')
+        self.hash_start, self.hash_buckets = (hashed[0] if len(hashed) > 0 else None), len(hashed)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for index in ['numeric_index', 'other_index', 'special_index', 'hash_start', 'hash_buckets', 'text_arrays']: state.pop(index, None)
+        return state
+
+    def __setstate__(self, state):
+        '''Index is rebuilt on load (also for vocabs pickled without one)'''
+        self.__dict__.update(state)
+        self._build_index()
+
+    @staticmethod
+    def _hash_key(code):
+        '''Key to hash an unknown code on - all values of a numeric (code, units) share a bucket'''
+        c,v,u,t = code.split('||')
+        return f'{c}||{u}' if t == 'numeric' else code
+
+    @staticmethod
+    def _nearest(values, xs):
+        '''Positions of the values (sorted) nearest to each of `xs` - the first of equally near values'''
+        if len(values) == 1: return np.zeros(len(xs), dtype=int)
+        right = np.searchsorted(values, xs).clip(1, len(values) - 1)
+        pos = np.where(np.abs(xs - values[right - 1]) <= np.abs(values[right] - xs), right - 1, right)
+        pos[np.isnan(xs)] = 0
+        return np.searchsorted(values, values[pos])
 
     def numericalize(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
         '''Numericalize observation codes (return indices for codes)'''
-
-        if log_excep:
-            today = date.today().strftime("%Y-%m-%d")
-            log_dir = LOG_STORE if log_dir=='default_log_store' else log_dir
-            if not os.path.isdir(log_dir): os.mkdir(log_dir)
-            logfile = f'{log_dir}/{today}_numericalize_exceptions.log'
-
-        indxs = []
-        for code in codes:
-            if code in ['xxnone','xxunk']: indxs.extend(self.vocab_df[(self.vocab_df['code'] == code)].index.tolist())
+        indxs, numerics = np.full(len(codes), -1), defaultdict(list)
+        for i, code in enumerate(codes):
+            if code in self.special_index: indxs[i] = self.special_index[code]
             else:
                 c,v,u,t = code.split('||')
-                if t == 'numeric':
-                    filt_df = self.vocab_df[(self.vocab_df['code'] == c) & (self.vocab_df['units'] == u) & (self.vocab_df['type'] == t)]
-                    res = filt_df.iloc[(filt_df.value - float(v)).abs().argsort()[:1]].index.tolist()
-                else:
-                    res = self.vocab_df[(self.vocab_df['code'] == c) & (self.vocab_df['value'] == v) & \
-                                               (self.vocab_df['units'] == u) & (self.vocab_df['type'] == t)].index.tolist()
-                if len(res) == 0:
-                    indxs.extend(self.vocab_df[(self.vocab_df['code'] == 'xxunk')].index.tolist())
-                    if log_excep:
-                        with open(logfile, 'a') as log:
-                            log.write(f'\ncode in ObsVocab: {code}')
-                else            : indxs.extend(res)
+                if t == 'numeric': numerics[c, u].append((i, float(v)))
+                else             : indxs[i] = self.other_index.get((c, v, u, t), -1)
+
+        # all values of a (code, units) are looked up at once
+        for key, items in numerics.items():
+            if key not in self.numeric_index: continue
+            pos, xs = np.array(items).T
+            values, rows = self.numeric_index[key]
+            indxs[pos.astype(int)] = rows[self._nearest(values, xs)]
+
+        unknown = np.flatnonzero(indxs == -1)
+        indxs[unknown] = self.special_index['xxunk']
+        if self.hash_buckets > 0 and len(unknown) > 0:
+            indxs[unknown] = self.hash_start + hash_codes([self._hash_key(codes[i]) for i in unknown], self.hash_buckets)
+        if log_excep and len(unknown) > 0: unknown_codes.add(self, [codes[i] for i in unknown], log_dir)
 
         assert len(codes) == len(indxs), "Possible bug, not all codes being numericalized"
-        return indxs
+        return indxs.tolist()
+
+    def numericalize_array(self, codes, log_excep=LOG_NUMERICALIZE_EXCEP, log_dir='default_log_store'):
+        '''Numericalize a whole array of observation codes at once - each distinct code is looked up (and logged) once'''
+        if hasattr(codes, 'to_pandas'): codes = codes.to_pandas()
+        nums, uniqs = pd.factorize(pd.Series(codes))
+        uniq_nums = self.numericalize(list(uniqs), log_excep, log_dir) + [self.special_index['xxunk']]
+        return np.array(uniq_nums, dtype=np.int32)[nums]
 
     def textify(self, indxs):
         '''Textify observation codes (returns codes and descriptions)'''
-        txts = []
-        for i in indxs:
-            c,d,v,u,t = self.vocab_df.iloc[i]
-            if i == 0: txts.append((c, d))
-            else:      txts.append((f'{c}||{v}||{u}||{t}', d))
+        codes, descs = self._text_arrays()
+        indxs = np.asarray(indxs, dtype=np.int64)
+        txts = list(zip(codes[indxs], descs[indxs]))
         assert len(indxs) == len(txts), "Possible bug, not all indxs being textified"
         return txts
 
+    def _text_arrays(self):
+        '''Concatenated `code||value||units||type` strings (just `xxnone` for row 0) & descriptions of all rows - built on first use'''
+        if not hasattr(self, 'text_arrays'):
+            df = self.vocab_df
+            codes = (df['code'].astype(str) + '||' + df['value'].astype(str) + '||' + df['units'].astype(str) + '||' + df['type'].astype(str)).values.astype(object)
+            codes[0] = df['code'].iloc[0]
+            self.text_arrays = codes, df['desc'].values.astype(object)
+        return self.text_arrays
+
+    @staticmethod
+    def _first_rows(df, keys):
+        '''First row of each `keys` in `df` - by code, then units (& value), each in order of appearance - with the desc of the first row of its (code, units)'''
+        rows = df.drop_duplicates(keys)
+        code_units = rows.groupby(['orig_code', 'units'], sort=False).ngroup().values
+        first = np.unique(code_units, return_index=True)[1]
+        rows = rows.assign(desc=rows.desc.values[first[code_units]])
+        return rows.iloc[np.lexsort((code_units, pd.factorize(rows.orig_code)[0]))]
+
+    @staticmethod
+    def _linspace(starts, stops, num):
+        '''`np.linspace(start, stop, num)` of each of `starts` & `stops` at once - a row for each'''
+        steps = (stops - starts) / max(num - 1, 1)
+        values = starts[:, None] + np.arange(num) * steps[:, None]
+        if num > 1: values[:, -1] = stops
+        return values
+
+    @classmethod
+    def _bucket_values(cls, numerics, keys, num_buckets, bucketing):
+        '''Bucket values (a row for each (code, units) in `keys`) - `linspace` from min to max or `quantile`s of the values, of all codes at once'''
+        groups = numerics.groupby(['orig_code', 'units'], sort=False).value
+        if bucketing == 'linspace':
+            bounds = groups.agg(['min', 'max']).reindex(keys)
+            return cls._linspace(bounds['min'].values, bounds['max'].values, num_buckets)
+        if bucketing == 'quantile':
+            return groups.quantile(np.linspace(0, 1, num_buckets)).unstack().reindex(keys).values
+        raise ValueError(f'Unknown bucketing "{bucketing}", must be one of "linspace" or "quantile"')
+
     @classmethod
-    def create(cls, obs_codes, num_buckets=5):
-        '''Create vocab object from observation codes'''
+    def create(cls, obs_codes, num_buckets=5, min_freq=1, max_size=None, hash_buckets=0, bucketing='linspace'):
+        '''Create vocab object from observation codes - numeric values in `num_buckets` buckets of each (code, units) (see `bucketing`), rare codes (see `prune_codes`) are left out,
+        unknown codes are numericalized to one of `hash_buckets` rows (if any) rather than `xxunk`'''
+        obs_codes = prune_codes(obs_codes, min_freq, max_size, col='orig_code')
         numerics = pd.DataFrame(obs_codes.loc[obs_codes['type'] == 'numeric',:])
         texts = pd.DataFrame(obs_codes.loc[obs_codes['type'] == 'text',:])
         numerics = numerics.astype({'value':'float'}, copy=False)
-        vocab_rows = []
-
-        for code in numerics.orig_code.unique():
-            this_code = numerics.loc[numerics['orig_code'] == code]
-            for unit in this_code.units.unique():
-                this_unit = this_code.loc[this_code['units'] == unit]
-                for val in np.linspace(this_unit.value.min(), this_unit.value.max(), num=num_buckets):
-                    vocab_rows.append([code,this_unit.desc.iloc[0],val,unit,'numeric'])
-
-        for code in texts.orig_code.unique():
-            this_code = texts.loc[texts['orig_code'] == code]
-            for unit in this_code.units.unique():
-                this_unit = this_code.loc[this_code['units'] == unit]
-                for val in this_unit.value.unique():
-                    vocab_rows.append([code,this_unit.desc.iloc[0],val,unit,'text'])
-
-        vocab_rows.insert(0, ['xxnone','Nothing recorded','xxnone','xxnone','xxnone'])
-        vocab_rows.insert(1, ['xxunk','Unknown','xxunk','xxunk','xxunk'])
-        amp_pad_sz, _ = multiple_of_8(len(vocab_rows))
-        for _ in range(amp_pad_sz):
-            vocab_rows.append(['xxamp','Padding for AMP','xxamp','xxamp','xxamp'])
-
-        obs_vocab = pd.DataFrame(data=vocab_rows, columns=['code','desc','value','units','type'])
+        columns = ['code','desc','value','units','type']
+
+        numerics_first = cls._first_rows(numerics, ['orig_code', 'units'])
+        keys = pd.MultiIndex.from_frame(numerics_first[['orig_code', 'units']])
+        values = cls._bucket_values(numerics, keys, num_buckets, bucketing)
+        keep = np.ones(values.shape, dtype=bool) # quantiles of skewed values can be equal - only distinct ones are kept
+        if bucketing == 'quantile': keep[:, 1:] = (np.diff(values, axis=1) != 0) & ~np.isnan(values[:, 1:])
+        repeats = keep.sum(axis=1)
+        numeric_rows = pd.DataFrame({'code': np.repeat(numerics_first.orig_code.values, repeats), 'desc': np.repeat(numerics_first.desc.values, repeats),
+                                     'value': values[keep].astype(object), 'units': np.repeat(numerics_first.units.values, repeats), 'type': 'numeric'})
+
+        texts_first = cls._first_rows(texts, ['orig_code', 'units', 'value'])
+        text_rows = pd.DataFrame({'code': texts_first.orig_code.values, 'desc': texts_first.desc.values, 'value': texts_first.value.values,
+                                  'units': texts_first.units.values, 'type': 'text'})
+
+        special_rows = pd.DataFrame([['xxnone','Nothing recorded','xxnone','xxnone','xxnone'], ['xxunk','Unknown','xxunk','xxunk','xxunk']], columns=columns)
+        hash_rows = pd.DataFrame([[f'xxhash{i}','Unknown (hashed)','xxhash','xxhash','xxhash'] for i in range(hash_buckets)], columns=columns)
+        amp_pad_sz, _ = multiple_of_8(len(special_rows) + len(numeric_rows) + len(text_rows) + len(hash_rows))
+        amp_rows = pd.DataFrame([['xxamp','Padding for AMP','xxamp','xxamp','xxamp']] * amp_pad_sz, columns=columns)
+
+        obs_vocab = pd.concat([special_rows, numeric_rows, text_rows, hash_rows, amp_rows], ignore_index=True)[columns]
 
         # test
-        xtra_uniqs = 3 if amp_pad_sz > 0 else 2
+        xtra_uniqs = (3 if amp_pad_sz > 0 else 2) + hash_buckets
         assert obs_codes.orig_code.nunique() == obs_vocab.code.nunique() - xtra_uniqs, "Possible bug, obs_code nuniques don't match"
 
         return cls(obs_vocab)
 
+# Cell
+VOCAB_VERSION = 2
+VOCAB_ARRAYS = ['strings', 'string_offsets', 'codes', 'descs', 'desc_offsets', 'desc_sets', 'values', 'value_strs', 'units', 'types']
+
+def encode_strings(strs):
+    '''Ids of `strs` (missing ones are -1) in a table of their unique strings - returns the ids and the table's utf-8 bytes & offsets'''
+    ids, uniqs = pd.factorize(pd.Series(strs, dtype=object))
+    encoded = [str(s).encode() for s in uniqs]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return ids.astype(np.int32), np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def decode_strings(data, offsets):
+    '''Table of strings encoded by `encode_strings` as an object array - with a trailing `np.nan` for id -1'''
+    data = bytes(data)
+    return np.array([data[start:stop].decode() for start, stop in zip(offsets[:-1], offsets[1:])] + [np.nan], dtype=object)
+
+def read_vocab_stamp(path):
+    '''Stamp of the vocabs saved for the dataset at `path` - `None` if there are none (or only a pickled vocab list)'''
+    fname = Path(f'{path}/processed/vocabs/vocabs.json')
+    return json.loads(fname.read_text())['stamp'] if fname.exists() else None
+
+# Cell
+class VocabDescs(Mapping):
+    '''`ctod` of a loaded vocab - each code's descriptions are only read from the vocab arrays when looked up'''
+    def __init__(self, ctoi, strings, descs, desc_offsets, desc_sets):
+        self.ctoi, self.strings, self.descs, self.desc_offsets, self.desc_sets = ctoi, strings, descs, desc_offsets, desc_sets
+
+    def __getitem__(self, code):
+        i = self.ctoi[code]
+        descs = self.strings[self.descs[self.desc_offsets[i]:self.desc_offsets[i+1]]]
+        return set(descs) if self.desc_sets[i] else descs[0]
+
+    def __iter__(self): return iter(self.ctoi)
+    def __len__(self): return len(self.ctoi)
+
 # Cell
 class EhrVocabList:
     '''Class to create and hold all vocab objects for an entire dataset'''
@@ -186,8 +410,10 @@ class EhrVocabList:
         self.age_mean, self.age_std = age_mean, age_std
 
     @classmethod
-    def create(cls, path, num_buckets=5):
-        '''Read all code dfs from the dataset path and create all vocab objects'''
+    def create(cls, path, num_buckets=5, min_freq=1, max_size=None, hash_buckets=0, bucketing='linspace'):
+        '''Read all code dfs from the dataset path and create all vocab objects - records vocabs without codes seen less than `min_freq` times
+        in training data, or beyond the `max_size` most frequent ones, and with `hash_buckets` rows for unknown codes (see `hash_codes`) -
+        observation values in `num_buckets` `linspace` or `quantile` buckets (see `ObsVocab.create`)'''
         demographics_vocabs, records_vocabs = [], []
         code_dfs = load_ehr_vocabcodes(path)
 
@@ -208,26 +434,100 @@ class EhrVocabList:
             return code_dfs, age_mean, age_std
 
         demographics_codes, age_mean, age_std = _get_demographics_codes(code_dfs[0])
-        demographics_vocabs.extend([EhrVocab.create(codes_df) for codes_df in demographics_codes])
-        records_vocabs.extend([ObsVocab.create(code_dfs[1], num_buckets)])
-        records_vocabs.extend([EhrVocab.create(codes_df) for codes_df in code_dfs[2:]])
+        demographics_names = ['birth_day', 'birth_month', 'birth_year', 'marital', 'race', 'ethnicity', 'gender', 'birthplace', 'city', 'state', 'zip']
+        demographics_vocabs.extend([EhrVocab.create(codes_df, name) for codes_df, name in zip(demographics_codes, demographics_names)])
+        records_vocabs.extend([ObsVocab.create(code_dfs[1], num_buckets, min_freq, max_size, hash_buckets, bucketing)])
+        records_vocabs.extend([EhrVocab.create(codes_df, name, min_freq, max_size, hash_buckets) for codes_df, name in zip(code_dfs[2:], FILENAMES[2:])])
         return cls(demographics_vocabs, records_vocabs, age_mean, age_std, path)
 
+    def _rows(self):
+        '''Codes & descriptions (`ctod` or `desc`) of all rows of all vocabs, values, units & types of `ObsVocab` rows - and each vocab's meta'''
+        rows, meta = defaultdict(list), defaultdict(list)
+        for group, vocabs in [('demographics_vocabs', self.demographics_vocabs), ('records_vocabs', self.records_vocabs)]:
+            for vocab in vocabs:
+                start, obs_start = len(rows['codes']), len(rows['types'])
+                if isinstance(vocab, ObsVocab):
+                    df = vocab.vocab_df
+                    numeric = np.array([isinstance(value, float) for value in df.value])
+                    rows['codes'].extend(df.code); rows['descs'].extend([desc] for desc in df.desc)
+                    rows['desc_sets'].extend([False] * len(df))
+                    rows['values'].extend(np.where(numeric, df.value, np.nan).astype(float))
+                    rows['value_strs'].extend(np.where(numeric, np.nan, df.value)); rows['units'].extend(df.units); rows['types'].extend(df.type)
+                else:
+                    ctod = getattr(vocab, 'ctod', {})
+                    descs = [ctod[code] if code in ctod else [] for code in vocab.itoc]
+                    rows['codes'].extend(vocab.itoc); rows['descs'].extend([desc] if isinstance(desc, str) else sorted(desc, key=str) for desc in descs) # sets in a fixed order, for a stable stamp
+                    rows['desc_sets'].extend(isinstance(desc, set) for desc in descs)
+                meta[group].append({'type': type(vocab).__name__, 'name': getattr(vocab, 'name', None), 'rows': [start, len(rows['codes'])],
+                                    'obs_rows': [obs_start, len(rows['types'])], 'ctod': hasattr(vocab, 'ctod')})
+        return rows, meta
+
     def save(self):
-        '''Save vocablist (containing all vocab objects for the dataset)'''
-        pckl_dir = Path(f'{self.path}/processed')
-        pckl_dir.mkdir(parents=True, exist_ok=True)
-        pckl_f = open(f'{pckl_dir}/vocabs.vocablist', 'wb')
-        pickle.dump(self, pckl_f)
-        pckl_f.close()
-        print(f'Saved vocab lists to {pckl_dir}')
+        '''Save vocablist (containing all vocab objects for the dataset) - as flat (memory-mappable) arrays and a stamped `vocabs.json`'''
+        vocab_dir = Path(f'{self.path}/processed/vocabs')
+        vocab_dir.mkdir(parents=True, exist_ok=True)
+        rows, meta = self._rows()
+
+        # a single table of all strings, all columns of strings are ids into it
+        desc_lens = [len(descs) for descs in rows['descs']]
+        string_cols = ['codes', 'descs', 'value_strs', 'units', 'types']
+        all_strs = [s for col in string_cols for s in ([s for descs in rows[col] for s in descs] if col == 'descs' else rows[col])]
+        ids, strings, string_offsets = encode_strings(all_strs)
+        arrays = {'strings': strings, 'string_offsets': string_offsets}
+        for col, col_ids in zip(string_cols, np.split(ids, np.cumsum([len(rows['codes']), sum(desc_lens), len(rows['types']), len(rows['types'])]))):
+            arrays[col] = col_ids
+        arrays['desc_offsets'] = np.concatenate([[0], np.cumsum(desc_lens)]).astype(np.int64)
+        arrays['desc_sets'] = np.array(rows['desc_sets'], dtype=bool)
+        arrays['values'] = np.array(rows['values'], dtype=np.float64)
+
+        md5 = hashlib.md5()
+        for name in VOCAB_ARRAYS:
+            np.save(vocab_dir/f'{name}.npy', arrays[name])
+            md5.update(arrays[name].tobytes())
+        meta.update({'version': VOCAB_VERSION, 'age_mean': self.age_mean, 'age_std': self.age_std})
+        md5.update(json.dumps(meta, sort_keys=True).encode())
+        self.stamp = meta['stamp'] = md5.hexdigest()
+        (vocab_dir/'vocabs.json').write_text(json.dumps(meta))
+
+        pckl_f = Path(f'{self.path}/processed/vocabs.vocablist')
+        if pckl_f.exists(): print(f'{pckl_f} (pickled by an earlier version) is superseded by {vocab_dir} and no longer loaded')
+        print(f'Saved vocab lists to {vocab_dir}')
 
     @classmethod
-    def load(cls, path):
-        '''Load previously created vocablist object (containing all vocab objects for the dataset)'''
-        infile = open(f'{path}/processed/vocabs.vocablist','rb')
-        ehrVocabList = pickle.load(infile)
-        infile.close()
+    def load(cls, path, mmap=False):
+        '''Load previously created vocablist object (containing all vocab objects for the dataset) - `mmap` to memory-map its arrays'''
+        vocab_dir = Path(f'{path}/processed/vocabs')
+        if not vocab_dir.exists(): # pickled by an earlier version
+            infile = open(f'{path}/processed/vocabs.vocablist','rb')
+            ehrVocabList = pickle.load(infile)
+            infile.close()
+            return ehrVocabList
+
+        meta = json.loads((vocab_dir/'vocabs.json').read_text())
+        if meta['version'] != VOCAB_VERSION:
+            raise Exception(f'"{vocab_dir}" has vocab format version {meta["version"]}, expected {VOCAB_VERSION} - create the vocabs again.')
+        arrays = {name: np.load(vocab_dir/f'{name}.npy', mmap_mode='r' if mmap else None) for name in VOCAB_ARRAYS}
+        strings = decode_strings(arrays['strings'], arrays['string_offsets'])
+        desc_offsets = arrays['desc_offsets']
+
+        def _vocab(vocab_meta):
+            (start, stop), (obs_start, obs_stop) = vocab_meta['rows'], vocab_meta['obs_rows']
+            codes = strings[arrays['codes'][start:stop]]
+            if vocab_meta['type'] == 'ObsVocab':
+                values = strings[arrays['value_strs'][obs_start:obs_stop]]
+                numeric = arrays['value_strs'][obs_start:obs_stop] == -1
+                values[numeric] = arrays['values'][obs_start:obs_stop][numeric]
+                vocab_df = pd.DataFrame({'code': codes, 'desc': strings[arrays['descs'][desc_offsets[start:stop]]], 'value': values,
+                                         'units': strings[arrays['units'][obs_start:obs_stop]], 'type': strings[arrays['types'][obs_start:obs_stop]]})
+                return ObsVocab(vocab_df)
+            itoc = list(codes)
+            ctoi = {code: i for i, code in enumerate(itoc)}
+            ctod = VocabDescs(ctoi, strings, arrays['descs'], desc_offsets[start:stop+1], arrays['desc_sets'][start:stop]) if vocab_meta['ctod'] else None
+            return EhrVocab(itoc, ctoi, ctod, vocab_meta['name'])
+
+        ehrVocabList = cls([_vocab(m) for m in meta['demographics_vocabs']], [_vocab(m) for m in meta['records_vocabs']],
+                           meta['age_mean'], meta['age_std'], path)
+        ehrVocabList.stamp = meta['stamp']
         return ehrVocabList
 
 # Cell
@@ -242,4 +542,14 @@ def get_all_emb_dims(EhrVocabList, αd=0.5736):
     for emb_dim in recs_dims:
         recs_dims_width += emb_dim[1]
 
-    return demographics_dims, recs_dims, demographics_dims_width, recs_dims_width
\ No newline at end of file
+    return demographics_dims, recs_dims, demographics_dims_width, recs_dims_width
+
+# Cell
+def get_emb_params(EhrVocabList, αd=0.5736):
+    '''Vocab sizes, embedding widths & parameter counts for all vocab objects of the dataset (and their totals)'''
+    vocabs = EhrVocabList.demographics_vocabs + EhrVocabList.records_vocabs
+    names = [getattr(vocab, 'name', type(vocab).__name__) for vocab in vocabs]
+    emb_params = pd.DataFrame([vocab.get_emb_dims(αd) for vocab in vocabs], index=names, columns=['vocab_size', 'width'])
+    emb_params['params'] = emb_params.vocab_size * emb_params.width
+    emb_params.loc['total'] = emb_params.sum()
+    return emb_params
\ No newline at end of file